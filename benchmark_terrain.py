@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+"""
+Timing of the terrain baking stages, run as: python benchmark_terrain.py
+The suite stage measures every stage over a matrix of sizes, writes JSON and compares
+it against a stored baseline: python benchmark_terrain.py suite --json results.json
+The check stage quickly compares the float32 stages with float64: python benchmark_terrain.py check
+"""
+# standard library
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from os.path import join, getsize
+from time import perf_counter
+from types import SimpleNamespace
+
+# external libraries
+import numpy as np
+
+# local imports
+from generate_terrain import compute_normals_grid, build_terrain_mesh, generate_perlin_noise_2d, perlin_gradients, \
+    generate_fractal_noise_2d, bake_terrain, save_baked, stamp_features, build_terrain_grid_mesh, build_rtin_mesh, \
+    apply_brush, update_normals_grid, lattice_gradients, generate_crater, generate_terrain, build_lava_mesh, save_i
+
+
+def build_terrain_mesh_loop(terrain, normals_grid):
+    """ Reference per-cell loop that build_terrain_mesh replaced """
+    vertices, normals = [], []
+    for x in range(terrain.shape[0] - 2):
+        for y in range(terrain.shape[1] - 2):
+            v1 = np.array([x, terrain[x, y], y])
+            v2 = np.array([x + 1, terrain[x + 1, y], y])
+            v3 = np.array([x, terrain[x, y + 1], y + 1])
+            v4 = np.array([x + 1, terrain[x + 1, y + 1], y + 1])
+            vertices.extend([v1, v3, v2] + [v2, v3, v4])
+
+            n1 = normals_grid[x, y, :]
+            n2 = normals_grid[x, y + 1, :]
+            n3 = normals_grid[x + 1, y, :]
+            n4 = normals_grid[x + 1, y + 1, :]
+            normals.extend([n1, n3, n2] + [n2, n3, n4])
+
+    return np.array(vertices, dtype=np.float32), np.array(normals, dtype=np.float32)
+
+
+def top_bone_weights_loop(bones, vertex_count, max_bones=128):
+    """ Reference conversion that bone_weight_triplets and top_bone_weights replaced:
+        max_bones sortable pairs per vertex filled entry by entry, then every row sorted
+        to keep the highest 4. bones: assimp-like bones with mWeights entries """
+    vbone = np.array([[(0, 0)] * max_bones] * vertex_count, dtype=[('weight', 'f4'), ('id', 'u4')])
+    for bone_id, bone in enumerate(bones[:max_bones]):
+        for entry in bone.mWeights:
+            vbone[entry.mVertexId][bone_id] = (entry.mWeight, bone_id)
+    vbone.sort(order='weight')
+    vbone = vbone[:, -4:]
+    return vbone['id'], vbone['weight']
+
+
+def generate_perlin_noise_2d_padded(shape, res):
+    """ Reference perlin noise that was computed on the next power of 2 shape and cropped """
+    def smoothen(t):
+        return 6 * t ** 5 - 15 * t ** 4 + 10 * t ** 3
+
+    shape_orig = shape
+    shape = (2 ** int(np.ceil(np.log2(shape[0]))), 2 ** int(np.ceil(np.log2(shape[1]))))
+    res_x, res_y = res
+    x, y = shape[0], shape[1]
+    dx, dy = res_x / x, res_y / y
+    nx, ny = -(-x // res_x), -(-y // res_y)
+
+    grid = np.mgrid[0:res_x:dx, 0:res_y:dy].transpose(1, 2, 0) % 1
+    gradients = perlin_gradients(res)
+    g00 = gradients[0:-1, 0:-1].repeat(nx, 0).repeat(ny, 1)[:x, :y]
+    g10 = gradients[1:, 0:-1].repeat(nx, 0).repeat(ny, 1)[:x, :y]
+    g01 = gradients[0:-1, 1:].repeat(nx, 0).repeat(ny, 1)[:x, :y]
+    g11 = gradients[1:, 1:].repeat(nx, 0).repeat(ny, 1)[:x, :y]
+    n00 = np.sum(grid * g00, 2)
+    n10 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1])) * g10, 2)
+    n01 = np.sum(np.dstack((grid[:, :, 0], grid[:, :, 1] - 1)) * g01, 2)
+    n11 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1] - 1)) * g11, 2)
+    t = smoothen(grid)
+    n0 = n00 * (1 - t[:, :, 0]) + t[:, :, 0] * n10
+    n1 = n01 * (1 - t[:, :, 0]) + t[:, :, 0] * n11
+    return np.sqrt(2) * ((1 - t[:, :, 1]) * n0 + t[:, :, 1] * n1)[:shape_orig[0], :shape_orig[1]]
+
+
+def timed(function, *args, repeat=1):
+    """ Best wall time of `repeat` calls, together with the last result """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function(*args)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def bench_mesh(dims=(300, 1000, 4000), loop_max_dim=1000):
+    """ Compare vectorized and looped mesh building; the loop is extrapolated
+        (quadratically in dim) above loop_max_dim, it takes minutes at 4k """
+    rng = np.random.default_rng(0)
+    loop_rate = None  # seconds per cell measured on the largest looped dim
+    print(f'{"dim":>6} {"cells":>10} {"vectorized [s]":>15} {"loop [s]":>12} {"speedup":>8}')
+    for dim in dims:
+        terrain = rng.random((dim, dim), dtype=np.float32) * 50
+        normals_grid = compute_normals_grid(terrain)
+        cells = (dim - 2) ** 2
+
+        t_vec, (vertices, normals) = timed(build_terrain_mesh, terrain, normals_grid, repeat=3)
+        if dim <= loop_max_dim:
+            t_loop, (vertices_loop, normals_loop) = timed(build_terrain_mesh_loop, terrain, normals_grid)
+            assert np.array_equal(vertices, vertices_loop) and np.array_equal(normals, normals_loop)
+            loop_rate = t_loop / cells
+            loop = f'{t_loop:12.3f}'
+        elif loop_rate is not None:
+            t_loop = loop_rate * cells
+            loop = f'{"~%.1f" % t_loop:>12}'
+        else:
+            t_loop, loop = None, f'{"-":>12}'
+        speedup = f'{t_loop / t_vec:8.0f}' if t_loop else f'{"-":>8}'
+        print(f'{dim:>6} {cells:>10} {t_vec:15.3f} {loop} {speedup}')
+
+
+def peak_memory(function, *args):
+    """ Peak of numpy allocations traced during one call, in bytes """
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_perlin(dims=(300, 1000, 4000, 1025, 4097), octaves=5, res=(1, 1), tile_rows=None):
+    """ Time and peak memory per octave of exact-size noise against the old
+        power of 2 padding; dims just above a power of 2 are the worst case """
+    print(f'{"dim":>6} {"octave":>6} {"padded [s]":>11} {"exact [s]":>10} {"padded [MB]":>12} {"exact [MB]":>11}')
+    for dim in dims:
+        shape = (dim, dim)
+        for octave in range(octaves):
+            octave_res = (res[0] * 2 ** octave, res[1] * 2 ** octave)
+            t_pad, _ = timed(generate_perlin_noise_2d_padded, shape, octave_res)
+            t_exact, _ = timed(lambda: generate_perlin_noise_2d(shape, octave_res, tile_rows=tile_rows))
+            m_pad = peak_memory(generate_perlin_noise_2d_padded, shape, octave_res) / 2 ** 20
+            m_exact = peak_memory(lambda: generate_perlin_noise_2d(shape, octave_res, tile_rows=tile_rows)) / 2 ** 20
+            print(f'{dim:>6} {octave + 1:>6} {t_pad:11.3f} {t_exact:10.3f} {m_pad:12.1f} {m_exact:11.1f}')
+
+
+def bench_headless(dims=(300, 1000), octaves=5):
+    """ Import time of generate_terrain in a fresh interpreter, and fractal noise
+        time without diagnostics against writing the octaves montage """
+    probe = ('import sys, time; start = time.perf_counter(); import generate_terrain; '
+             'print(time.perf_counter() - start, "matplotlib" in sys.modules)')
+    imported, matplotlib_loaded = subprocess.run([sys.executable, '-c', probe], capture_output=True,
+                                                 text=True, check=True).stdout.split()
+    print(f'import generate_terrain: {float(imported):.3f} s, matplotlib imported: {matplotlib_loaded}')
+
+    print(f'{"dim":>6} {"headless [s]":>13} {"montage [s]":>12}')
+    with tempfile.TemporaryDirectory() as directory:
+        for dim in dims:
+            shape = (dim, dim)
+            t_headless, _ = timed(lambda: generate_fractal_noise_2d(shape, (1, 1), octaves, 0.3, seed=0))
+            montage = join(directory, 'noise.png')
+            t_montage, _ = timed(lambda: generate_fractal_noise_2d(shape, (1, 1), octaves, 0.3, seed=0,
+                                                                   montage=montage))
+            print(f'{dim:>6} {t_headless:13.3f} {t_montage:12.3f}')
+
+
+def bench_features(dims=(1000, 2000), counts=(10, 100, 1000), bucket_size=64):
+    """ Stamping random craters, cones and depressions in one bucketed pass,
+        against one pass per feature as chained generate_crater calls do """
+    print(f'{"dim":>6} {"features":>9} {"one pass [s]":>13} {"per feature [s]":>16}')
+    for dim in dims:
+        terrain = np.random.default_rng(0).random((dim, dim)) * 50
+        for count in counts:
+            rng = np.random.default_rng(count)
+            n = count // 3 + 1
+            craters = (rng.integers(0, dim, (n, 2)), 30, rng.uniform(5, 20, n), 4)
+            cones = (rng.integers(0, dim, (n, 2)), 20, rng.uniform(5, 40, n))
+            depressions = (rng.integers(0, dim, (n, 2)), 10, rng.uniform(10, 30, n))
+            t_once, _ = timed(lambda: stamp_features(terrain.copy(), craters, cones, depressions, bucket_size))
+
+            def per_feature():
+                stamped = terrain.copy()
+                for i in range(n):
+                    stamp_features(stamped, craters=(craters[0][i], 30, craters[2][i], 4))
+                    stamp_features(stamped, cones=(cones[0][i], 20, cones[2][i]))
+                    stamp_features(stamped, depressions=(depressions[0][i], 10, depressions[2][i]))
+            t_each, _ = timed(per_feature)
+            print(f'{dim:>6} {3 * n:>9} {t_once:13.3f} {t_each:16.3f}')
+
+
+def bench_packing(dims=(300, 1000, 2000)):
+    """ Vertex buffer sizes of a baked terrain with the packed formats the viewer
+        uploads against plain float32, and the largest error of the packed normals """
+    from core import FLOAT, HALF, PACKED_NORMAL  # OpenGL modules needed, but no context
+    print(f'{"dim":>6} {"float32 [MB]":>13} {"packed [MB]":>12} {"saved":>6} {"normal error [deg]":>19} {"pack [s]":>9}')
+    for dim in dims:
+        baked = bake_terrain(dim=dim, crater_radius=dim // 10, hole_radius=dim // 30)
+        buffers = ((baked['ground_vertices'], FLOAT), (baked['ground_normals'], PACKED_NORMAL),
+                   (baked['lava_vertices'], HALF))
+        floats = sum(np.asarray(data, np.float32).nbytes for data, _ in buffers)
+        t_pack, packed = timed(lambda: [attribute_format.pack(data) for data, attribute_format in buffers])
+
+        # decode the 10 bit signed fields back, as the GPU does
+        bits = packed[1].view(np.uint32)[:, None] >> np.array([0, 10, 20], np.uint32) & 0x3ff
+        decoded = np.where(bits >= 512, bits.astype(np.int32) - 1024, bits) / 511
+        normals = baked['ground_normals']
+        cosine = np.sum(decoded * normals, axis=1) / np.linalg.norm(decoded, axis=1) / np.linalg.norm(normals, axis=1)
+        error = np.degrees(np.arccos(np.clip(cosine, -1, 1))).max()
+
+        size = sum(p.nbytes for p in packed)
+        print(f'{dim:>6} {floats / 2 ** 20:13.2f} {size / 2 ** 20:12.2f} {1 - size / floats:6.0%} {error:19.3f} '
+              f'{t_pack:9.3f}')
+
+
+def bench_rtin(dims=(300, 1000, 2000), max_errors=(0.1, 0.5, 1, 2, 5)):
+    """ Triangle count and build time of the simplified mesh at several
+        error thresholds, against the dense grid mesh """
+    print(f'{"dim":>6} {"max error":>9} {"triangles":>10} {"of dense":>9} {"time [s]":>9}')
+    for dim in dims:
+        terrain = generate_fractal_noise_2d((dim, dim), (1, 1), 5, 0.3, seed=0) * 70
+        normals_grid = compute_normals_grid(terrain)
+        t_dense, (_, _, indices) = timed(build_terrain_grid_mesh, terrain, normals_grid)
+        dense = len(indices) // 3
+        print(f'{dim:>6} {"dense":>9} {dense:>10} {1:9.1%} {t_dense:9.3f}')
+        for max_error in max_errors:
+            t_rtin, (_, _, indices) = timed(build_rtin_mesh, terrain, normals_grid, max_error)
+            print(f'{dim:>6} {max_error:>9} {len(indices) // 3:>10} {len(indices) // 3 / dense:9.1%} {t_rtin:9.3f}')
+
+
+def bench_brush(dims=(1000, 2000, 4000), radius=20):
+    """ CPU time and bytes to upload for one brush stroke, recomputing and packing only
+        the touched rows, against rebuilding and uploading the whole terrain mesh """
+    from core import pack_float, pack_int_2_10_10_10  # OpenGL modules needed, but no context
+    print(f'{"dim":>6} {"stroke [ms]":>12} {"stroke [kB]":>12} {"rebuild [ms]":>13} {"rebuild [MB]":>13}')
+    for dim in dims:
+        terrain = np.random.default_rng(0).random((dim, dim), dtype=np.float32) * 50
+        normals_grid = compute_normals_grid(terrain)
+
+        def stroke():
+            touched = apply_brush(terrain, 'crater', (dim / 2, dim / 3), radius, 5.0)
+            x_low, x_high, z_low, z_high = update_normals_grid(terrain, normals_grid, *touched)
+            sent = 0
+            for x in range(x_low, x_high):  # one upload per row, as EditableTerrain does
+                z = np.arange(z_low, z_high)
+                sent += pack_float(np.stack((np.full(len(z), x), terrain[x, z], z), axis=1)).nbytes
+                sent += pack_int_2_10_10_10(normals_grid[x, z_low:z_high]).nbytes
+            return sent
+
+        def rebuild():
+            vertices, normals, _ = build_terrain_grid_mesh(terrain, compute_normals_grid(terrain))
+            return pack_float(vertices).nbytes + pack_int_2_10_10_10(normals).nbytes
+
+        t_stroke, sent = timed(stroke, repeat=5)
+        t_rebuild, size = timed(rebuild)
+        print(f'{dim:>6} {t_stroke * 1000:12.2f} {sent / 1024:12.1f} {t_rebuild * 1000:13.1f} {size / 2 ** 20:13.1f}')
+
+
+# loads a baked terrain and reads every array the way the viewer uploads it, in a fresh interpreter
+LOAD_PROBE = """
+import sys, time, tracemalloc
+import numpy as np
+from generate_terrain import load_baked
+tracemalloc.start()
+start = time.perf_counter()
+baked = load_baked(sys.argv[1])
+for name, data in baked.items():
+    if not name.endswith('indices'):
+        data = np.ascontiguousarray(data, np.float32)  # as VertexArray does before glBufferData
+    np.add.reduce(data.reshape(-1))                    # the driver reads all of it
+seconds = time.perf_counter() - start
+rss = next(line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM'))
+print(seconds, tracemalloc.get_traced_memory()[1], rss)
+"""
+
+
+def normal_angle(normals, reference):
+    """ Largest angle [deg] between two grids of unit normals; arctan2 rather than
+        arccos, which cannot resolve angles under ~0.02 deg near a cosine of 1 """
+    normals = np.asarray(normals, np.float64)
+    sine = np.linalg.norm(np.cross(normals, reference), axis=-1)
+    return np.degrees(np.arctan2(sine, np.sum(normals * reference, axis=-1)).max())
+
+
+def check_float32(dim=129, octaves=5, height_tolerance=1e-3, normal_tolerance=1e-2):
+    """ Every float32 stage written into out= buffers against the float64 path, at a
+        small size: the result is the buffer, in float32, and within tolerance """
+    res = (2, 3)  # not dividing dim, the lattice falls between grid points
+    gradients = perlin_gradients(res)
+    noise64 = generate_perlin_noise_2d((dim, dim), res, gradients)
+    out = np.empty((dim, dim), np.float32)
+    noise32 = generate_perlin_noise_2d((dim, dim), res, gradients, tile_rows=16, out=out)
+    assert noise32 is out and noise32.dtype == np.float32, 'perlin noise not written into out'
+    assert np.abs(noise32 - noise64).max() < 1e-5, 'float32 perlin noise drifted from float64'
+
+    fractal64 = generate_fractal_noise_2d((dim, dim), (1, 1), octaves, seed=0)
+    for workers in (1, 2):
+        out = np.empty((dim, dim), np.float32)
+        fractal32 = generate_fractal_noise_2d((dim, dim), (1, 1), octaves, seed=0, workers=workers, out=out)
+        assert fractal32 is out and fractal32.dtype == np.float32, 'fractal noise not written into out'
+        assert np.abs(fractal32 - fractal64).max() < 1e-5, 'float32 fractal noise drifted from float64'
+
+    with redirect_stdout(open(os.devnull, 'w')):  # crater report
+        terrain64 = generate_terrain(dim, crater_center=(dim // 2, dim // 2), crater_radius=8, seed=0,
+                                     dtype=np.float64)[0]
+        terrain32 = generate_terrain(dim, crater_center=(dim // 2, dim // 2), crater_radius=8, seed=0)[0]
+    assert terrain32.dtype == np.float32, 'terrain not generated in float32'
+    assert np.abs(terrain32 - terrain64).max() < height_tolerance, 'float32 terrain drifted from float64'
+
+    normals64 = compute_normals_grid(terrain64)
+    out = np.empty((dim - 1, dim - 1, 3), np.float32)
+    normals32 = compute_normals_grid(terrain32, out=out)
+    assert normals32 is out and normals32.dtype == np.float32, 'normals not written into out'
+    assert normal_angle(normals32, normals64) < normal_tolerance, 'float32 normals drifted from float64'
+
+    out = np.empty(((dim - 1) ** 2, 3), np.float32)
+    vertices, normals, _ = build_terrain_grid_mesh(terrain32, normals32, out=out)
+    assert vertices is out, 'mesh vertices not written into out'
+    assert np.abs(vertices[:, 1] - terrain64[:-1, :-1].reshape(-1)).max() < height_tolerance, \
+        'float32 mesh heights drifted from float64'
+    assert normals.dtype == np.float32 and normal_angle(normals, normals64.reshape(-1, 3)) < normal_tolerance, \
+        'float32 mesh normals drifted from float64'
+    print(f'float32 check passed at dim {dim}')
+
+
+def bench_float32(dims=(1000, 2000, 4000)):
+    """ Terrain and normals computed in float32 end to end against the float64
+        path: time and peak memory, check_float32 checks the results """
+    print(f'{"dim":>6} {"f64 [s]":>8} {"f32 [s]":>8} {"f64 [MB]":>9} {"f32 [MB]":>9}')
+    for dim in dims:
+        def pipeline(dtype):
+            terrain = generate_terrain(dim, crater_center=(dim // 2, dim // 2), seed=0, dtype=dtype)[0]
+            return terrain, compute_normals_grid(terrain)
+
+        with redirect_stdout(open(os.devnull, 'w')):  # crater report
+            t64 = timed(pipeline, np.float64)[0]
+            t32 = timed(pipeline, np.float32)[0]
+            m64, m32 = (peak_memory(pipeline, dtype) / 2 ** 20 for dtype in (np.float64, np.float32))
+        print(f'{dim:>6} {t64:8.3f} {t32:8.3f} {m64:9.1f} {m32:9.1f}')
+
+
+def bench_lava(dims=(300, 1000, 2000), hole_radii=(0, 10, 30)):
+    """ Greedy lava mesh of craters with growing holes against one quad per cell;
+        a crater without a hole has no lava and an empty mesh """
+    print(f'{"dim":>6} {"hole":>5} {"cells":>8} {"triangles":>10} {"per cell":>9} {"time [s]":>9}')
+    for dim in dims:
+        for hole_radius in hole_radii:
+            with redirect_stdout(open(os.devnull, 'w')):  # crater report
+                _, crater_inside, crater_edge_height = generate_terrain(dim, crater_center=(dim // 2, dim // 2),
+                                                                        hole_radius=hole_radius, seed=0)
+            t_lava, (vertices, indices) = timed(build_lava_mesh, crater_inside, crater_edge_height)
+            cells = len(crater_inside)
+            print(f'{dim:>6} {hole_radius:>5} {cells:>8} {len(indices) // 3:>10} {2 * cells:>9} {t_lava:9.4f}')
+            if not cells:
+                assert vertices.shape == (0, 3) and len(indices) == 0, 'lava mesh of an empty crater'
+
+
+def bench_bones(dims=(10000, 100000), bone_count=64, influences=6, loop_max_dim=100000):
+    """ Top 4 bone weights of skinned meshes with dims vertices, each influenced by
+        several random bones, from the same assimp-like bones: gathering triplets and
+        selecting them vectorized (gather alone in its own column) against the dense
+        per-entry loop """
+    from core import bone_weight_triplets, top_bone_weights  # OpenGL modules needed, but no context
+    rng = np.random.default_rng(0)
+    print(f'{"vertices":>9} {"loop [s]":>9} {"vector [s]":>11} {"gather [s]":>11} {"loop [MB]":>10} '
+          f'{"vector [MB]":>12} {"same":>5}')
+
+    def vectorized(bones, vertex_count):
+        return top_bone_weights(*bone_weight_triplets(bones), vertex_count)
+
+    for dim in dims:
+        # distinct bones per vertex, as assimp gives at most one weight per (vertex, bone)
+        bone_ids = np.argsort(rng.random((dim, bone_count)), axis=1)[:, :influences].reshape(-1)
+        vertex_ids = np.repeat(np.arange(dim), influences)
+        weights = rng.random(dim * influences).astype(np.float32)
+        # bones with one object per weight entry, as assimp gives them
+        bones = [SimpleNamespace(mWeights=[SimpleNamespace(mVertexId=v, mWeight=w) for v, w in
+                                           zip(vertex_ids[bone_ids == b].tolist(), weights[bone_ids == b].tolist())])
+                 for b in range(bone_count)]
+
+        t_gather, _ = timed(bone_weight_triplets, bones)
+        t_vec, (ids, vec_weights) = timed(vectorized, bones, dim)
+        m_vec = peak_memory(vectorized, bones, dim) / 2 ** 20
+        if dim <= loop_max_dim:
+            t_loop, (loop_ids, loop_weights) = timed(top_bone_weights_loop, bones, dim)
+            m_loop = peak_memory(top_bone_weights_loop, bones, dim) / 2 ** 20
+            loop_weights = loop_weights / loop_weights.sum(axis=1, keepdims=True)
+            same = np.array_equal(ids, loop_ids) and np.allclose(vec_weights, loop_weights, rtol=1e-6)
+            print(f'{dim:>9} {t_loop:9.3f} {t_vec:11.3f} {t_gather:11.3f} {m_loop:10.1f} {m_vec:12.1f} '
+                  f'{str(same):>5}')
+            assert same, 'vectorized bone weights differ from the loop'
+        else:
+            print(f'{dim:>9} {"-":>9} {t_vec:11.3f} {t_gather:11.3f} {"-":>10} {m_vec:12.1f} {"-":>5}')
+
+
+def bench_load(dims=(1000, 2000)):
+    """ Startup time and peak memory of loading a baked terrain from .npz
+        against the memory-mapped .npy directory """
+    print(f'{"dim":>6} {"format":>6} {"load [s]":>9} {"heap peak [MB]":>15} {"peak RSS [MB]":>14}')
+    with tempfile.TemporaryDirectory() as directory:
+        for dim in dims:
+            baked = bake_terrain(dim=dim, crater_radius=dim // 10, hole_radius=dim // 30)
+            np.savez(join(directory, f'terrain{dim}.npz'), **baked)
+            save_baked(join(directory, f'terrain{dim}'), **baked)
+            del baked
+            for name, path in (('npz', f'terrain{dim}.npz'), ('mmap', f'terrain{dim}')):
+                result = subprocess.run([sys.executable, '-c', LOAD_PROBE, join(directory, path)],
+                                        capture_output=True, text=True, check=True)
+                seconds, heap, rss = result.stdout.split()
+                print(f'{dim:>6} {name:>6} {float(seconds):9.3f} {int(heap) / 2 ** 20:15.1f} {int(rss) / 2 ** 10:14.1f}')
+
+
+def output_bytes(result):
+    """ Size of what a stage returns: its arrays, or the file written for a path """
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, str):
+        return getsize(result)
+    if isinstance(result, dict):
+        result = result.values()
+    if isinstance(result, (tuple, list, type({}.values()))):
+        return sum(output_bytes(item) for item in result)
+    return 0
+
+
+def measure(function, make_args, repeat=3):
+    """ Best wall time of repeat calls, traced peak memory of one more call and the
+        bytes of its output; inputs come fresh from make_args and are not measured """
+    seconds = float('inf')
+    for _ in range(repeat):
+        args = make_args()
+        start = perf_counter()
+        function(*args)
+        seconds = min(seconds, perf_counter() - start)
+    args = make_args()
+    tracemalloc.start()
+    result = function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(seconds=seconds, peak_bytes=peak, output_bytes=output_bytes(result))
+
+
+def suite_cases(dims, octave_counts, crater_radii, directory):
+    """ (stage, params, function, make_args) of every suite measurement, one dim at a time;
+        each case is measured before the next one is made """
+    for dim in dims:
+        shape = (dim, dim)
+        terrain = (generate_fractal_noise_2d(shape, (1, 1), 5, 0.3, seed=0) * 50).astype(np.float32)
+        normals_grid = compute_normals_grid(terrain)
+        gradients = lattice_gradients((8, 8), seed=0)
+
+        def save(path, ground, normals):
+            with redirect_stdout(open(os.devnull, 'w')):
+                save_i(path, overwrite=True, ground=ground, normals=normals)
+            return path + '.npz'
+
+        yield 'perlin', dict(dim=dim), generate_perlin_noise_2d, lambda: (shape, (8, 8), gradients)
+        for octaves in octave_counts:
+            yield 'fractal', dict(dim=dim, octaves=octaves), generate_fractal_noise_2d, \
+                lambda octaves=octaves: (shape, (1, 1), octaves, 0.3, False, None, 0)
+        for radius in crater_radii:
+            if 8 * radius <= dim:  # the crater window has to fit in the terrain
+                yield 'crater', dict(dim=dim, radius=radius), generate_crater, \
+                    lambda radius=radius: (None, 40, radius, radius // 3, terrain.copy())
+        yield 'normals', dict(dim=dim), compute_normals_grid, lambda: (terrain,)
+        yield 'mesh', dict(dim=dim), build_terrain_grid_mesh, lambda: (terrain, normals_grid)
+        yield 'mesh_soup', dict(dim=dim), build_terrain_mesh, lambda: (terrain, normals_grid)
+        yield 'save', dict(dim=dim), save, lambda: (join(directory, 'terrain'), terrain, normals_grid)
+
+
+def case_key(stage, params):
+    if not params:
+        return stage
+    return f'{stage}[' + ','.join(f'{name}={value}' for name, value in params.items()) + ']'
+
+
+def scaling(results):
+    """ Exponent of wall time and peak memory against dim, log-log slope per stage and other params """
+    curves = {}
+    for result in results.values():
+        others = {name: value for name, value in result['params'].items() if name != 'dim'}
+        curves.setdefault(case_key(result['stage'], others), []).append(result)
+    exponents = {}
+    for key, points in curves.items():
+        if len(points) > 1:
+            dims = np.log([point['params']['dim'] for point in points])
+            exponents[key] = {measure: round(float(np.polyfit(dims, np.log([max(p[measure], 1e-9) for p in points]),
+                                                                 1)[0]), 2)
+                              for measure in ('seconds', 'peak_bytes')}
+    return exponents
+
+
+def run_suite(dims=(128, 256, 512, 1024), octave_counts=(1, 3, 5), crater_radii=(8, 16, 32), repeat=3):
+    """ Measure every stage in isolation over the matrix, as a JSON-ready dict """
+    results = {}
+    print(f'{"case":<36} {"time [s]":>9} {"peak [MB]":>10} {"output [MB]":>12}')
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, params, function, make_args in suite_cases(dims, octave_counts, crater_radii, directory):
+            with redirect_stdout(open(os.devnull, 'w')):  # stages report progress
+                result = measure(function, make_args, repeat)
+            key = case_key(stage, params)
+            results[key] = dict(stage=stage, params=params, **result)
+            print(f'{key:<36} {result["seconds"]:9.4f} {result["peak_bytes"] / 2 ** 20:10.1f} '
+                  f'{result["output_bytes"] / 2 ** 20:12.1f}')
+    meta = dict(date=datetime.now().isoformat(timespec='seconds'), python=platform.python_version(),
+                numpy=np.__version__, machine=platform.machine(), processor=platform.processor(), repeat=repeat)
+    return dict(meta=meta, results=results, scaling=scaling(results))
+
+
+def compare(report, baseline, time_tolerance=1.5, memory_tolerance=1.1, time_slack=0.05):
+    """ Print cases slower or bigger than the baseline by more than the tolerances
+        (ratios), returns the number of regressions. Times depend on the machine,
+        memory and output sizes should not; time differences under time_slack
+        seconds are jitter on the smallest cases """
+    regressions = 0
+    print(f'{"case":<36} {"time":>7} {"peak":>7} {"output":>7}  (ratio to baseline)')
+    for key, result in report['results'].items():
+        reference = baseline['results'].get(key)
+        if reference is None:
+            print(f'{key:<36} not in baseline')
+            continue
+        ratios = [result[measure] / max(reference[measure], 1e-9) for measure in ('seconds', 'peak_bytes', 'output_bytes')]
+        slower = ratios[0] > time_tolerance and result['seconds'] - reference['seconds'] > time_slack
+        worse = slower or max(ratios[1:]) > memory_tolerance
+        regressions += worse
+        print(f'{key:<36} {ratios[0]:7.2f} {ratios[1]:7.2f} {ratios[2]:7.2f}' + ('  REGRESSION' if worse else ''))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('stages', nargs='*', choices=['check', 'mesh', 'perlin', 'headless', 'load', 'features',
+                                                      'packing', 'rtin', 'brush', 'float32', 'bones', 'lava', 'suite'],
+                        default=['check', 'mesh', 'perlin', 'headless', 'load', 'features', 'packing', 'rtin', 'brush',
+                                 'float32', 'bones', 'lava'])
+    parser.add_argument('--dims', type=int, nargs='+', help='grid sizes, each stage has its own default')
+    parser.add_argument('--loop-max-dim', type=int, default=1000,
+                        help='largest dim for which the reference loop really runs')
+    parser.add_argument('--octaves', type=int, default=5)
+    parser.add_argument('--tile-rows', type=int, default=None)
+    suite = parser.add_argument_group('suite')
+    suite.add_argument('--octave-counts', type=int, nargs='+', default=[1, 3, 5])
+    suite.add_argument('--crater-radii', type=int, nargs='+', default=[8, 16, 32])
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--json', help='write the suite results to this file')
+    suite.add_argument('--baseline', default='benchmark_baseline.json', help='results to compare against')
+    suite.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    suite.add_argument('--time-tolerance', type=float, default=1.5)
+    suite.add_argument('--memory-tolerance', type=float, default=1.1)
+    suite.add_argument('--time-slack', type=float, default=0.05, help='seconds of difference always tolerated')
+    args = parser.parse_args()
+    dims = dict(dims=args.dims) if args.dims else {}
+    if 'check' in args.stages:
+        check_float32()
+    if 'mesh' in args.stages:
+        bench_mesh(loop_max_dim=args.loop_max_dim, **dims)
+    if 'perlin' in args.stages:
+        bench_perlin(octaves=args.octaves, tile_rows=args.tile_rows, **dims)
+    if 'headless' in args.stages:
+        bench_headless(octaves=args.octaves, **dims)
+    if 'load' in args.stages:
+        bench_load(**dims)
+    if 'features' in args.stages:
+        bench_features(**dims)
+    if 'packing' in args.stages:
+        bench_packing(**dims)
+    if 'rtin' in args.stages:
+        bench_rtin(**dims)
+    if 'brush' in args.stages:
+        bench_brush(**dims)
+    if 'float32' in args.stages:
+        bench_float32(**dims)
+    if 'bones' in args.stages:
+        bench_bones(**dims)
+    if 'lava' in args.stages:
+        bench_lava(**dims)
+    if 'suite' in args.stages:
+        report = run_suite(octave_counts=args.octave_counts, crater_radii=args.crater_radii, repeat=args.repeat,
+                           **dims)
+        print(json.dumps(report['scaling'], indent=1))
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=1)
+        if args.save_baseline:
+            with open(args.baseline, 'w') as file:
+                json.dump(report, file, indent=1)
+            print(f'Baseline saved to {args.baseline}')
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                regressions = compare(report, json.load(file), args.time_tolerance, args.memory_tolerance,
+                                      args.time_slack)
+            if regressions:
+                print(f'{regressions} regressions against {args.baseline}')
+                sys.exit(1)
+        else:
+            print(f'No baseline at {args.baseline}, store one with --save-baseline')
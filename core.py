@@ -2,6 +2,8 @@
 import os                           # os function, i.e. checking file status
 from itertools import cycle         # allows easy circular choice list
 import atexit                       # launch a function at exit
+from bisect import bisect_left      # prefix search in sorted names
+from time import perf_counter       # texture resolution timing
 
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
@@ -11,12 +13,63 @@ import assimpcy                     # 3D resource loader
 
 # our transform functions
 from transform import Trackball, identity, rotate
+from mesh_bundle import bundle_path, fresh_bundle, read_bundle, write_bundle
 
 # initialize and automatically terminate glfw on exit
 glfw.init()
 atexit.register(glfw.terminate)
 
 
+# ------------ view frustum and fog culling ---------------------------------
+# distance at which the fragment shaders fade objects out completely (fog_max + 10)
+FOG_DISAPPEARING_DISTANCE = 160
+
+
+def sphere_around(low, high):
+    """ Bounding sphere (center, radius) of an axis aligned box """
+    low, high = np.asarray(low, np.float32), np.asarray(high, np.float32)
+    return (low + high) / 2, float(np.linalg.norm(high - low)) / 2
+
+
+def bounds_of(drawable):
+    """ Bounding sphere of a drawable, looking through decorators like Textured.
+        The first bounds found win: a decorator setting them to None, for vertices
+        its shaders move away from the mesh, opts the drawable out of culling """
+    while drawable is not None and not hasattr(drawable, 'bounds'):
+        drawable = getattr(drawable, 'drawable', None)
+    return getattr(drawable, 'bounds', None)
+
+
+class Culling:
+    """ Per-frame visibility test of bounding spheres against the view frustum
+        and the fog disappearing distance. Callers count what they skip in culled,
+        one per drawable or terrain chunk, meshes count their draw calls in drawn """
+
+    def __init__(self, view, projection, fog_distance=FOG_DISAPPEARING_DISTANCE):
+        self.view, self.projection = view, projection
+        self.fog_distance = fog_distance
+        # frustum planes (left, right, bottom, top, near, far) from the clip matrix rows
+        clip = projection @ view
+        planes = np.array([clip[3] + clip[0], clip[3] - clip[0], clip[3] + clip[1],
+                           clip[3] - clip[1], clip[3] + clip[2], clip[3] - clip[2]])
+        self.planes = planes / np.linalg.norm(planes[:, :3], axis=1)[:, None]
+        self.culled, self.drawn = 0, 0
+
+    def visible(self, bounds, model):
+        """ False if the sphere, placed by model, can not show up on screen """
+        if bounds is None:
+            return True  # unknown extent, always drawn
+        center, radius = bounds
+        center = model @ np.append(center, 1)
+        radius *= np.linalg.norm(model[:3, :3], axis=0).max()
+
+        outside = np.any(self.planes @ center < -radius)
+        # the shaders fade on clip space distance, which is at least the clip depth
+        depth = -(self.view @ center)[2] - radius
+        faded = depth > 0 and -self.projection[2, 2] * depth + self.projection[2, 3] >= self.fog_distance
+        return not (outside or faded)
+
+
 # ------------ low level OpenGL object wrappers ----------------------------
 class Shader:
     """ Helper class to create and automatically destroy shader program """
@@ -95,41 +148,121 @@ class Shader:
     }
 
 
+def pack_float(data):
+    """ 32 bit floats, the default """
+    return np.ascontiguousarray(data, np.float32)
+
+
+def pack_half(data):
+    """ 16 bit floats: integers up to 2048 are exact, otherwise ~3 significant digits """
+    return np.ascontiguousarray(data, np.float16)
+
+
+def pack_unorm(data, dtype=np.uint8):
+    """ Values in [0, 1] as normalized unsigned integers of dtype """
+    return np.rint(np.clip(data, 0, 1) * np.iinfo(dtype).max).astype(dtype)
+
+
+def pack_uint8(data):
+    """ Small integers, like bone ids, read back as floats by the shader """
+    return np.ascontiguousarray(data, np.uint8)
+
+
+def pack_int_2_10_10_10(data):
+    """ Vectors in [-1, 1] (normals) as one int32 per row: 10 signed normalized
+        bits each for x, y and z, 2 for an optional w (GL_INT_2_10_10_10_REV) """
+    data = np.asarray(data, np.float32).reshape(len(data), -1)
+    bits = np.rint(np.clip(data[:, :4], -1, 1) * (511, 511, 511, 1)[:data.shape[1]]).astype(np.int32)
+    packed = np.zeros(len(data), np.uint32)
+    for shift, (component, mask) in enumerate(zip(bits.T, (0x3ff, 0x3ff, 0x3ff, 0x3))):
+        packed |= (component.astype(np.uint32) & mask) << np.uint32(10 * shift)
+    return packed.view(np.int32)
+
+
+class AttributeFormat:
+    """ How a vertex attribute is stored on the GPU: GL component type,
+        normalization, components per vertex if fixed, and its packing function """
+    def __init__(self, gl_type, pack, normalized=False, size=None):
+        self.gl_type, self.pack = gl_type, pack
+        self.normalized, self.size = normalized, size
+
+
+FLOAT = AttributeFormat(GL.GL_FLOAT, pack_float)
+HALF = AttributeFormat(GL.GL_HALF_FLOAT, pack_half)
+PACKED_NORMAL = AttributeFormat(GL.GL_INT_2_10_10_10_REV, pack_int_2_10_10_10, normalized=True, size=4)
+UNORM8 = AttributeFormat(GL.GL_UNSIGNED_BYTE, pack_unorm, normalized=True)
+UNORM16 = AttributeFormat(GL.GL_UNSIGNED_SHORT, lambda data: pack_unorm(data, np.uint16), normalized=True)
+UINT8 = AttributeFormat(GL.GL_UNSIGNED_BYTE, pack_uint8)
+
+
 class VertexArray:
     """ helper class to create and self destroy OpenGL vertex array objects."""
-    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+
+    # sizes of all live vertex attribute buffers, as uploaded and as they would be in float32
+    packed_bytes, float_bytes = 0, 0
+
+    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW, formats=None):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex.
+            formats optionally maps attribute names to an AttributeFormat,
+            the others are stored as float32. """
 
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.glid)
         self.buffers = {}  # we will store buffers in a named dict
+        self.formats = {}
+        self.packed_bytes, self.float_bytes = 0, 0
         nb_primitives, size = 0, 0
 
+        # bounding box and sphere of 3D positions, for view frustum culling
+        self.aabb, self.bounds = None, None
+
         # load buffer per vertex attribute (in list with index = shader layout)
         for name, data in attributes.items():
             loc = GL.glGetAttribLocation(shader.glid, name)
             if loc >= 0:
                 # bind a new vbo, upload its data to GPU, declare size and type
                 self.buffers[name] = GL.glGenBuffers(1)
-                data = np.array(data, np.float32, copy=False)  # ensure format
+                data = np.ascontiguousarray(data, np.float32)  # ensure format, no copy if already
                 nb_primitives, size = data.shape
+                if name == 'position' and size == 3 and nb_primitives:
+                    self.aabb = data.min(axis=0), data.max(axis=0)
+                    self.bounds = sphere_around(*self.aabb)
+                attribute_format = self.formats[name] = (formats or {}).get(name, FLOAT)
+                packed = attribute_format.pack(data)
+                self.packed_bytes += packed.nbytes
+                self.float_bytes += data.nbytes
                 GL.glEnableVertexAttribArray(loc)
                 GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[name])
-                GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
-                GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                GL.glBufferData(GL.GL_ARRAY_BUFFER, packed, usage)
+                GL.glVertexAttribPointer(loc, attribute_format.size or size, attribute_format.gl_type,
+                                         attribute_format.normalized, 0, None)
+        VertexArray.packed_bytes += self.packed_bytes
+        VertexArray.float_bytes += self.float_bytes
 
         # optionally create and upload an index buffer for this object
         self.draw_command = GL.glDrawArrays
         self.arguments = (0, nb_primitives)
         if index is not None:
             self.buffers['index'] = GL.glGenBuffers(1)
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
+            # 16 bit indices are kept as they are, anything else is 32 bit
+            index_buffer = np.asarray(index)
+            short = index_buffer.dtype == np.uint16
+            index_buffer = np.asarray(index_buffer, np.uint16 if short else np.uint32)
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers['index'])
             GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
             self.draw_command = GL.glDrawElements
-            self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+            index_type = GL.GL_UNSIGNED_SHORT if short else GL.GL_UNSIGNED_INT
+            self.arguments = (index_buffer.size, index_type, None)
+
+    def update(self, name, data, first=0):
+        """ Overwrite the rows of attribute name starting at vertex first, only
+            their byte range is uploaded. Returns the number of bytes sent """
+        packed = self.formats[name].pack(data)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[name])
+        GL.glBufferSubData(GL.GL_ARRAY_BUFFER, first * (packed.nbytes // len(packed)), packed)
+        return packed.nbytes
 
     def execute(self, primitive, attributes=None):
         """ draw a vertex array, either as direct array or indexed array """
@@ -138,26 +271,44 @@ class VertexArray:
         attributes = attributes or {}
         for name, data in attributes.items():
             GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[name])
-            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data)
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, self.formats[name].pack(data))
 
         GL.glBindVertexArray(self.glid)
         self.draw_command(primitive, *self.arguments)
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
+        VertexArray.packed_bytes -= self.packed_bytes
+        VertexArray.float_bytes -= self.float_bytes
         GL.glDeleteVertexArrays(1, [self.glid])
         GL.glDeleteBuffers(len(self.buffers), list(self.buffers.values()))
 
 
+def vertex_memory_report():
+    """ VRAM of all live vertex attribute buffers against storing them as float32,
+        vertex fetch bandwidth per frame shrinks in the same proportion """
+    packed, floats = VertexArray.packed_bytes, VertexArray.float_bytes
+    saved = 1 - packed / floats if floats else 0
+    return (f'Vertex attributes: {packed / 2 ** 20:.2f} MB on GPU instead of {floats / 2 ** 20:.2f} MB '
+            f'as float32, {saved:.0%} less VRAM and vertex fetch bandwidth')
+
+
 # ------------  Mesh is the core drawable -------------------------------------
 class Mesh:
-    """ Basic mesh class, attributes and uniforms passed as arguments """
+    """ Basic mesh class, attributes and uniforms passed as arguments.
+        attributes may also be an existing VertexArray, shared with other meshes """
     def __init__(self, shader, attributes, index=None,
-                 usage=GL.GL_STATIC_DRAW, **uniforms):
+                 usage=GL.GL_STATIC_DRAW, formats=None, **uniforms):
         self.shader = shader
         self.uniforms = uniforms
-        self.vertex_array = VertexArray(shader, attributes, index, usage)
+        if isinstance(attributes, VertexArray):
+            self.vertex_array = attributes
+        else:
+            self.vertex_array = VertexArray(shader, attributes, index, usage, formats)
+        self.bounds = self.vertex_array.bounds
 
-    def draw(self, primitives=GL.GL_TRIANGLES, attributes=None, **uniforms):
+    def draw(self, primitives=GL.GL_TRIANGLES, attributes=None, culling=None, **uniforms):
+        if culling is not None:
+            culling.drawn += 1
         GL.glUseProgram(self.shader.glid)
         self.shader.set_uniforms({**self.uniforms, **uniforms})
         self.vertex_array.execute(primitives, attributes)
@@ -176,11 +327,15 @@ class Node:
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
 
-    def draw(self, model=identity(), **other_uniforms):
-        """ Recursive draw, passing down updated model matrix. """
+    def draw(self, model=identity(), culling=None, **other_uniforms):
+        """ Recursive draw, passing down updated model matrix. Children with
+            bounds are skipped when culling says they can not be seen """
         self.world_transform = model @ self.transform
         for child in self.children:
-            child.draw(model=self.world_transform, **{**self.uniforms, **other_uniforms})
+            if culling is not None and not culling.visible(bounds_of(child), self.world_transform):
+                culling.culled += 1
+                continue
+            child.draw(model=self.world_transform, culling=culling, **{**self.uniforms, **other_uniforms})
             # note: order of applying dictionary union allows for overriding (other > self)
 
     def key_handler(self, key):
@@ -196,11 +351,54 @@ class Node:
 # -------------- 3D resource loader -------------------------------------------
 MAX_BONES = 128
 
+
+def bone_weight_triplets(bones):
+    """ Flat (vertex ids, bone ids, weights) arrays of assimp bones, bone ids being
+        their index. Weights given as a structured array are used as they are,
+        otherwise each bone is read into arrays in one pass over its entries """
+    vertex_ids, weights = [], []
+    for bone in bones:
+        entries = bone.mWeights
+        if not (isinstance(entries, np.ndarray) and entries.dtype.names):
+            entries = np.fromiter(((entry.mVertexId, entry.mWeight) for entry in entries),
+                                  [('mVertexId', np.int64), ('mWeight', np.float32)], len(entries))
+        vertex_ids.append(entries['mVertexId'])
+        weights.append(entries['mWeight'])
+    bone_ids = np.repeat(np.arange(len(weights)), [len(w) for w in weights])
+    return (np.concatenate(vertex_ids or [np.empty(0, np.int64)]).astype(np.int64), bone_ids,
+            np.concatenate(weights or [np.empty(0, np.float32)]).astype(np.float32))
+
+
+def top_bone_weights(vertex_ids, bone_ids, weights, vertex_count, count=4):
+    """ The `count` heaviest bone influences of each vertex from flat (vertex, bone,
+        weight) triplets, as (ids, weights) arrays of vertex_count rows: lightest
+        first and zero padded in front, the higher bone id winning ties, weights
+        renormalized to sum to 1 """
+    vertex_ids = np.asarray(vertex_ids, np.int64)
+    weights = np.maximum(np.asarray(weights, np.float32), 0) + np.float32(0)  # no negative or -0.0 weights
+    # weight then bone id in one integer, bits of non-negative floats order as their values
+    keys = weights.view(np.uint32).astype(np.uint64) << np.uint64(32) | np.asarray(bone_ids, np.uint64)
+
+    # influences of every vertex side by side, zero keys for the missing ones
+    influences = np.bincount(vertex_ids, minlength=vertex_count)
+    order = np.argsort(vertex_ids, kind='stable')
+    slots = np.arange(len(order)) - (np.cumsum(influences) - influences)[vertex_ids[order]]
+    dense = np.zeros((vertex_count, max(count, influences.max(initial=0))), np.uint64)
+    dense[vertex_ids[order], slots] = keys[order]
+
+    # heaviest `count` per row without sorting the rows, then only those are ordered
+    top = np.sort(np.partition(dense, dense.shape[1] - count, axis=1)[:, -count:], axis=1)
+    ids = (top & np.uint64(0xffffffff)).astype(np.uint32)
+    weights = (top >> np.uint64(32)).astype(np.uint32).view(np.float32)
+    total = weights.sum(axis=1, keepdims=True)
+    return ids, np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
+
 # optionally load texture module
 try:
     from texture import Texture, Textured
+    from texture_cache import textures
 except ImportError:
-    Texture, Textured = None, None
+    Texture, Textured, textures = None, None, None
 
 # optionally load animation module
 try:
@@ -209,36 +407,93 @@ except ImportError:
     KeyFrameControlNode, Skinned = None, None
 
 
-def load(file, shader, tex_file=None, **params):
-    """ load resources from file using assimp, return node hierarchy """
+class TextureIndex:
+    """ File names of a directory tree, walked once and shared by every load()
+        of a model under that root; rebuilt when a directory modification time changes """
+    indices = {}        # absolute root -> shared index
+    resolve_time = 0.   # seconds spent resolving texture names, over all loads
+
+    def __init__(self, root):
+        self.root = root
+        self.build()
+
+    @classmethod
+    def of(cls, root):
+        """ Up to date index of root, created on first use """
+        index = cls.indices.get(os.path.abspath(root))
+        if index is None:
+            index = cls.indices[os.path.abspath(root)] = cls(root)
+        elif index.stale():
+            index.build()
+        return index
+
+    def build(self):
+        self.mtimes, files = {}, []
+        for directory, _, names in os.walk(self.root, followlinks=True):
+            self.mtimes[directory] = os.stat(directory).st_mtime_ns
+            files += [(name, len(files) + i, os.path.join(directory, name)) for i, name in enumerate(names)]
+        self.files = sorted(files)  # (name, walk order, path)
+        self.names = [name for name, _, _ in self.files]
+        self.exact = {}             # name -> (walk order, path) of its first occurrence
+        for name, order, file in self.files:
+            self.exact.setdefault(name, (order, file))
+
+    def stale(self):
+        """ Whether files were added or removed since the walk, one stat per directory """
+        try:
+            return any(os.stat(d).st_mtime_ns != mtime for d, mtime in self.mtimes.items())
+        except OSError:  # directory removed
+            return True
+
+    def find(self, name):
+        """ First file in walk order whose name starts with name, or is a prefix of it """
+        first = bisect_left(self.names, name)
+        last = bisect_left(self.names, name + chr(0x10ffff), first)
+        matches = [(order, file) for _, order, file in self.files[first:last]]
+        matches += [self.exact[name[:k]] for k in range(1, len(name)) if name[:k] in self.exact]
+        return min(matches, default=(None, None))[1]
+
+
+def post_process_flags():
+    """ assimp post-processing applied to every loaded file """
+    pp = assimpcy.aiPostProcessSteps
+    flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
+    flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
+    flags |= pp.aiProcess_GenSmoothNormals
+    flags |= pp.aiProcess_ImproveCacheLocality
+    flags |= pp.aiProcess_RemoveRedundantMaterials
+    return flags
+
+
+def import_scene(file, flags, tex_file=None):
+    """ Scene of file imported with assimp as plain data, no OpenGL involved:
+        node hierarchy, first animation, and per mesh its vertex attributes,
+        material uniforms, texture file and bones. None if it can not be read """
     try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
-        flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
-        flags |= pp.aiProcess_GenSmoothNormals
-        flags |= pp.aiProcess_ImproveCacheLocality
-        flags |= pp.aiProcess_RemoveRedundantMaterials
         scene = assimpcy.aiImportFile(file, flags)
     except assimpcy.all.AssimpError as exception:
         print('ERROR loading', file + ': ', exception.args[0].decode())
-        return []
+        return None
 
-    # ----- Pre-load textures; embedded textures not supported at the moment
+    # ----- Resolve textures; embedded textures not supported at the moment
     path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
+    index, resolve_time = None, 0.
     for mat in scene.mMaterials:
         if tex_file:
             tfile = tex_file
         elif 'TEXTURE_BASE' in mat.properties:  # texture token
             name = mat.properties['TEXTURE_BASE'].split('/')[-1].split('\\')[-1]
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            tfile = next((os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)), None)
+            # search texture in file's whole subdir since path often screwed up,
+            # the subtree is indexed once for all materials and loads
+            start = perf_counter()
+            index = index or TextureIndex.of(path)
+            tfile = index.find(name)
+            resolve_time += perf_counter() - start
             assert tfile, 'Cannot find texture %s in %s subtree' % (name, path)
         else:
             tfile = None
-        if Texture is not None and tfile:
-            mat.properties['diffuse_map'] = Texture(tex_file=tfile)
+        mat.properties['diffuse_file'] = tfile
+    TextureIndex.resolve_time += resolve_time
 
     # ----- load animations
     def conv(assimp_keys, ticks_per_second):
@@ -257,32 +512,18 @@ def load(file, shader, tex_file=None, **params):
                 conv(channel.mScalingKeys, anim.mTicksPerSecond)
             )
 
-    # ---- prepare scene graph nodes
-    nodes = {}                                       # nodes name -> node lookup
-    nodes_per_mesh_id = [[] for _ in scene.mMeshes]  # nodes holding a mesh_id
+    # ---- scene graph as nested (name, transform, mesh ids, children) tuples
+    def hierarchy(assimp_node):
+        return (assimp_node.mName, assimp_node.mTransformation, list(assimp_node.mMeshes),
+                [hierarchy(child) for child in assimp_node.mChildren])
 
-    def make_nodes(assimp_node):
-        """ Recursively builds nodes for our graph, matching assimp nodes """
-        keyframes = transform_keyframes.get(assimp_node.mName, None)
-        if keyframes and KeyFrameControlNode:
-            node = KeyFrameControlNode(*keyframes, assimp_node.mTransformation)
-        else:
-            node = Node(transform=assimp_node.mTransformation)
-        nodes[assimp_node.mName] = node
-        for mesh_index in assimp_node.mMeshes:
-            nodes_per_mesh_id[mesh_index] += [node]
-        node.add(*(make_nodes(child) for child in assimp_node.mChildren))
-        return node
-
-    root_node = make_nodes(scene.mRootNode)
-
-    # ---- create optionally decorated (Skinned, Textured) Mesh objects
-    for mesh_id, mesh in enumerate(scene.mMeshes):
+    # ---- per mesh data of optionally decorated (Skinned, Textured) Mesh objects
+    meshes = []
+    for mesh in scene.mMeshes:
         # retrieve materials associated to this mesh
         mat = scene.mMaterials[mesh.mMaterialIndex].properties
 
-        # initialize mesh with args from file, merge and override with params
-        index = mesh.mFaces
+        # initialize mesh with args from file, merged and overridden with params at load
         uniforms = dict(
             k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
             k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
@@ -303,36 +544,159 @@ def load(file, shader, tex_file=None, **params):
             attributes.update(color=mesh.mColors[0])
 
         # ---- compute and add optional skinning vertex attributes
+        bones = None
         if mesh.HasBones:
-            # skinned mesh: weights given per bone => convert per vertex for GPU
-            # first, populate an array with MAX_BONES entries per vertex
-            vbone = np.array([[(0, 0)] * MAX_BONES] * mesh.mNumVertices,
-                             dtype=[('weight', 'f4'), ('id', 'u4')])
-            for bone_id, bone in enumerate(mesh.mBones[:MAX_BONES]):
-                for entry in bone.mWeights:  # need weight,id pairs for sorting
-                    vbone[entry.mVertexId][bone_id] = (entry.mWeight, bone_id)
+            # skinned mesh: weights given per bone => convert per vertex for GPU,
+            # keeping the highest 4 of the (vertex, bone, weight) triplets
+            bone_ids, bone_weights = top_bone_weights(*bone_weight_triplets(mesh.mBones[:MAX_BONES]),
+                                                      mesh.mNumVertices)
+
+            attributes.update(bone_ids=bone_ids,
+                              bone_weights=bone_weights)
+            # bone names & offset matrices, indexed by bone index (id)
+            bones = ([bone.mName for bone in mesh.mBones], [bone.mOffsetMatrix for bone in mesh.mBones])
+
+        meshes.append(dict(attributes=attributes, index=mesh.mFaces, uniforms=uniforms,
+                           diffuse_file=mat['diffuse_file'], bones=bones))
+
+    return dict(root=hierarchy(scene.mRootNode), keyframes=transform_keyframes, meshes=meshes,
+                faces=sum(mesh.mNumFaces for mesh in scene.mMeshes), animations=scene.mNumAnimations,
+                resolve_time=resolve_time)
+
+
+def upload_scene(scene, shader):
+    """ GPU side of an imported scene: a vertex array and texture per mesh,
+        the vertex attributes are not kept """
+    meshes = []
+    for mesh in scene['meshes']:
+        # compact storage: unit vectors in 4 bytes, texture coordinates in
+        # half floats, normalized colors and weights, bone ids fit in a byte
+        formats = dict(normal=PACKED_NORMAL, tex_coord=HALF, color=UNORM8,
+                       bone_ids=UINT8, bone_weights=UNORM16)
+        vertex_array = VertexArray(shader, mesh['attributes'], mesh['index'], formats=formats)
+        diffuse_map = None
+        if Texture is not None and mesh['diffuse_file']:
+            diffuse_map = textures.acquire(mesh['diffuse_file'])  # shared by materials and loads
+        meshes.append(dict(vertex_array=vertex_array, diffuse_map=diffuse_map,
+                           uniforms=mesh['uniforms'], bones=mesh['bones']))
+    return {**scene, 'meshes': meshes, 'shader': shader}
+
+
+class MeshCache:
+    """ Uploaded scenes kept in memory, keyed by file path and modification time,
+        post-process flags, shader and texture file: loading a file again only builds
+        a new node hierarchy around the same vertex arrays and textures """
+    _MISSING = object()  # no modification time to keep when invalidating
+
+    def __init__(self):
+        self.assets = {}
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(file, flags, shader, tex_file=None):
+        mtime = os.stat(file).st_mtime_ns if os.path.exists(file) else None
+        # the shader object, not its GL name which a new program can reuse after deletion;
+        # cached scenes hold their shader, so its id is not reused while they are cached
+        return os.path.abspath(file), mtime, int(flags), id(shader), tex_file
+
+    def get(self, key):
+        asset = self.assets.get(key)
+        if asset is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return asset
 
-            vbone.sort(order='weight')   # sort rows, high weights last
-            vbone = vbone[:, -4:]        # limit bone size, keep highest 4
+    def put(self, key, asset):
+        # versions of the file with another modification time are outdated
+        self.invalidate(key[0], keep_mtime=key[1])
+        self.assets[key] = asset
 
-            attributes.update(bone_ids=vbone['id'],
-                              bone_weights=vbone['weight'])
+    def invalidate(self, file=None, keep_mtime=_MISSING):
+        """ Forget the scenes of file, or of every file, and release their textures.
+            Vertex arrays are freed with the last node hierarchy still drawing them """
+        path = file and os.path.abspath(file)
+        for key in [key for key in self.assets if path in (None, key[0]) and key[1] != keep_mtime]:
+            for mesh in self.assets.pop(key)['meshes']:
+                if mesh['diffuse_map'] is not None:
+                    textures.release(mesh['diffuse_map'])
 
-        new_mesh = Mesh(shader, attributes, index, **{**uniforms, **params})
+    def bytes(self):
+        """ VRAM of the cached vertex arrays """
+        return sum(mesh['vertex_array'].packed_bytes for asset in self.assets.values() for mesh in asset['meshes'])
+
+    def report(self):
+        return (f'Mesh cache: {len(self.assets)} scenes, {self.bytes() / 2 ** 20:.2f} MB of vertex arrays, '
+                f'{self.hits} hits, {self.misses} misses')
+
+
+# shared by every load() call
+mesh_cache = MeshCache()
+
+
+def load(file, shader, tex_file=None, **params):
+    """ load resources from file using assimp, return node hierarchy. Geometry and
+        textures are shared with earlier loads of the unchanged file with the same shader,
+        a bundle from mesh_bundle.py newer than the file is mapped instead of importing it """
+    flags = post_process_flags()
+    key = mesh_cache.key(file, flags, shader, tex_file)
+    asset = mesh_cache.get(key)
+    source = 'cached'
+    if asset is None:
+        bundle = fresh_bundle(file)
+        scene = bundle and read_bundle(bundle, flags, tex_file)
+        if scene:
+            source = 'from ' + bundle
+        else:
+            scene = import_scene(file, flags, tex_file)
+            if scene is None:
+                return []
+            source = 'textures resolved in %.1f ms' % (scene['resolve_time'] * 1000)
+            # an outdated or unreadable bundle is replaced, unless tex_file overrode the materials
+            if os.path.exists(bundle_path(file)) and not tex_file:
+                try:
+                    write_bundle(bundle_path(file), scene, flags)
+                except OSError as exception:
+                    print('ERROR writing', bundle_path(file) + ':', exception)
+        asset = upload_scene(scene, shader)
+        mesh_cache.put(key, asset)
+
+    # ---- prepare scene graph nodes, new ones each time as they are moved around
+    nodes = {}                                          # nodes name -> node lookup
+    nodes_per_mesh_id = [[] for _ in asset['meshes']]   # nodes holding a mesh_id
+
+    def make_nodes(name, transform, mesh_ids, children):
+        """ Recursively builds nodes for our graph, matching assimp nodes """
+        keyframes = asset['keyframes'].get(name, None)
+        if keyframes and KeyFrameControlNode:
+            node = KeyFrameControlNode(*keyframes, transform)
+        else:
+            node = Node(transform=transform)
+        nodes[name] = node
+        for mesh_index in mesh_ids:
+            nodes_per_mesh_id[mesh_index] += [node]
+        node.add(*(make_nodes(*child) for child in children))
+        return node
+
+    root_node = make_nodes(*asset['root'])
+
+    # ---- create optionally decorated (Skinned, Textured) Mesh objects
+    for mesh_id, mesh in enumerate(asset['meshes']):
+        # uniforms from file, merged and overridden with params
+        new_mesh = Mesh(shader, mesh['vertex_array'], **{**mesh['uniforms'], **params})
 
-        if Textured is not None and 'diffuse_map' in mat:
-            new_mesh = Textured(new_mesh, diffuse_map=mat['diffuse_map'])
-        if Skinned and mesh.HasBones:
+        if Textured is not None and mesh['diffuse_map'] is not None:
+            new_mesh = Textured(new_mesh, diffuse_map=mesh['diffuse_map'])
+        if Skinned and mesh['bones']:
             # make bone lookup array & offset matrix, indexed by bone index (id)
-            bone_nodes = [nodes[bone.mName] for bone in mesh.mBones]
-            bone_offsets = [bone.mOffsetMatrix for bone in mesh.mBones]
-            new_mesh = Skinned(new_mesh, bone_nodes, bone_offsets)
+            bone_names, bone_offsets = mesh['bones']
+            new_mesh = Skinned(new_mesh, [nodes[name] for name in bone_names], bone_offsets)
+            new_mesh.bounds = None  # posed by the bones, the bind pose bounds do not hold
         for node_to_populate in nodes_per_mesh_id[mesh_id]:
             node_to_populate.add(new_mesh)
 
-    nb_triangles = sum((mesh.mNumFaces for mesh in scene.mMeshes))
-    print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations)' %
-          (scene.mNumMeshes, nb_triangles, len(nodes), scene.mNumAnimations))
+    print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations, %s)' %
+          (len(asset['meshes']), asset['faces'], len(nodes), asset['animations'], source))
     return [root_node]
 
 
@@ -343,6 +707,7 @@ class Viewer(Node):
     def __init__(self, width=640, height=480):
         super().__init__()
         self.cacti_list = []
+        self.culling = None  # culled / drawn counts of the last frame
 
         # version hints: create GL window with >= OpenGL 3.3 and core profile
         glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
@@ -396,12 +761,17 @@ class Viewer(Node):
             #     print(f"{self.trackball.distance=}")
             #     print(f"{self.trackball.pos2d=}")
 
-            # draw our scene objects
-            cam_pos = np.linalg.inv(self.trackball.view_matrix())[:, 3]
-            self.draw(view=self.trackball.view_matrix(),
-                      projection=self.trackball.projection_matrix(win_size),
+            # draw our scene objects, skipping what is out of view or lost in the fog
+            view = self.trackball.view_matrix()
+            projection = self.trackball.projection_matrix(win_size)
+            self.culling = Culling(view, projection)
+            cam_pos = np.linalg.inv(view)[:, 3]
+            self.draw(view=view,
+                      projection=projection,
                       model=identity(),
                       w_camera_position=cam_pos,
+                      win_size=win_size,
+                      culling=self.culling,
                       time=glfw.get_time() % 22)   # == almost 7 PI
 
             # flush render commands, and swap draw buffers
@@ -422,6 +792,9 @@ class Viewer(Node):
             if key == glfw.KEY_S:
                 for c in self.cacti_list:
                     c.apply(rotate((0, 1, 0), 5))
+            if key == glfw.KEY_C and self.culling:
+                print(f'Last frame: {self.culling.drawn} draw calls, '
+                      f'{self.culling.culled} drawables or terrain chunks culled')
 
             # call Node.key_handler which calls key_handlers for all drawables
             self.key_handler(key)
@@ -1,77 +1,224 @@
 # standard library
-from os.path import exists
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs
+from os.path import exists, isdir, join
 from sys import stderr
 
 # external libraries
 import numpy as np
-import matplotlib.pyplot as plt
+# matplotlib is only imported by the plotting functions, generation stays headless
 
 
 # local imports
 # -
 
 # perlin noise code adapted from: https://github.com/pvigier/perlin-numpy
-def generate_perlin_noise_2d(shape, res):
-    def smoothen(t):
-        return 6 * t ** 5 - 15 * t ** 4 + 10 * t ** 3
+def smoothen(t):
+    return 6 * t ** 5 - 15 * t ** 4 + 10 * t ** 3
 
-    # make shape a nearest power of 2
-    shape_orig = shape
-    shape = (2 ** int(np.ceil(np.log2(shape[0]))), 2 ** int(np.ceil(np.log2(shape[1]))))
 
+def perlin_gradients(res):
+    """ Random unit gradients at the (res_x + 1, res_y + 1) lattice points """
+    angles = 2 * np.pi * np.random.rand(res[0] + 1, res[1] + 1)
+    return np.dstack((np.cos(angles), np.sin(angles)))
+
+
+def hash32(h):
+    """ Mix the bits of uint32 values (lowbias32 integer hash) """
+    with np.errstate(over='ignore'):
+        h = h ^ (h >> np.uint32(16))
+        h = h * np.uint32(0x7feb352d)
+        h = h ^ (h >> np.uint32(15))
+        h = h * np.uint32(0x846ca68b)
+        return h ^ (h >> np.uint32(16))
+
+
+def octave_seed(seed, octave):
+    """ Seed of one noise octave, derived from the base seed """
+    return int(hash32(np.uint32((seed ^ octave * 0x9e3779b9) & 0xffffffff)))
+
+
+def hashed_gradients(cell_x, cell_y, seed=0):
+    """ Unit gradients at integer lattice points (cell_x, cell_y), a pure function
+        of the coordinates and the seed - no global RNG state involved """
+    h = hash32(np.uint32(seed & 0xffffffff))
+    h = hash32(np.asarray(cell_y).astype(np.uint32) ^ h)
+    h = hash32(np.asarray(cell_x).astype(np.uint32) ^ h)
+    angles = h * (2 * np.pi / 2 ** 32)
+    return np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+
+
+def lattice_gradients(res, seed=0):
+    """ Hashed counterpart of perlin_gradients, same table layout """
+    cell_x, cell_y = np.meshgrid(np.arange(res[0] + 1), np.arange(res[1] + 1), indexing='ij')
+    return hashed_gradients(cell_x, cell_y, seed)
+
+
+def generate_perlin_noise_2d(shape, res, gradients=None, tile_rows=None, out=None, dtype=None):
+    """ Perlin noise of exactly `shape`, with `res` lattice cells along each axis;
+        res does not need to divide the shape.
+        gradients: table from perlin_gradients(res), drawn at random if None
+        tile_rows: evaluate blocks of this many rows at a time, temporaries then
+                   stay a small multiple of one block instead of the whole shape
+        out: preallocated array of `shape` to write the noise into
+        dtype: precision of the temporaries and result, out's dtype or float64 by default """
     res_x, res_y = res
     x, y = shape[0], shape[1]
     dx, dy = res_x / x, res_y / y
-    nx, ny = x // res_x, y // res_y
-    if x % res_x != 0:
-        nx += 1
-    if y % res_y != 0:
-        ny += 1
 
-    grid = np.mgrid[0:res_x:dx, 0:res_y:dy].transpose(1, 2, 0) % 1
+    if dtype is None:
+        dtype = np.float64 if out is None else out.dtype
     # Gradients
-    angles = 2 * np.pi * np.random.rand(res_x + 1, res_y + 1)
-    gradients = np.dstack((np.cos(angles), np.sin(angles)))
-    g00 = gradients[0:-1, 0:-1].repeat(nx, 0).repeat(ny, 1)[:x, :y]
-    g10 = gradients[1:, 0:-1].repeat(nx, 0).repeat(ny, 1)[:x, :y]
-    g01 = gradients[0:-1, 1:].repeat(nx, 0).repeat(ny, 1)[:x, :y]
-    g11 = gradients[1:, 1:].repeat(nx, 0).repeat(ny, 1)[:x, :y]
+    if gradients is None:
+        gradients = perlin_gradients(res)
+    gradients = np.asarray(gradients, dtype)
+    if out is None:
+        out = np.empty(shape, dtype)
+    tile_rows = tile_rows or x
+
+    # lattice cell and position inside of it, per column
+    pos_y = np.arange(y) * dy
+    cell_y = np.floor(pos_y).astype(int)[None, :]
+    for first_row in range(0, x, tile_rows):
+        pos_x = np.arange(first_row, min(first_row + tile_rows, x)) * dx
+        cell_x = np.floor(pos_x).astype(int)[:, None]
+        grid = np.empty((len(pos_x), y, 2), dtype)
+        grid[:, :, 0] = pos_x[:, None] - cell_x
+        grid[:, :, 1] = pos_y - cell_y
+        # Ramps, from the gradients at the corners of the lattice cell of each point
+        n00 = np.sum(grid * gradients[cell_x, cell_y], 2)
+        n10 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1])) * gradients[cell_x + 1, cell_y], 2)
+        n01 = np.sum(np.dstack((grid[:, :, 0], grid[:, :, 1] - 1)) * gradients[cell_x, cell_y + 1], 2)
+        n11 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1] - 1)) * gradients[cell_x + 1, cell_y + 1], 2)
+        # Interpolation
+        t = smoothen(grid)
+        n0 = n00 * (1 - t[:, :, 0]) + t[:, :, 0] * n10
+        n1 = n01 * (1 - t[:, :, 0]) + t[:, :, 0] * n11
+        # a python float keeps float32 temporaries float32, a numpy float64 scalar would not
+        out[first_row:first_row + len(pos_x)] = float(np.sqrt(2)) * ((1 - t[:, :, 1]) * n0 + t[:, :, 1] * n1)
+    return out
+
+
+def perlin_noise_at(points, seed=0):
+    """ Perlin noise at points (..., 2) given in lattice units, with hashed
+        gradients: any set of points can be evaluated on its own """
+    points = np.asarray(points, dtype=np.float64)
+    cell = np.floor(points)
+    grid = points - cell
+    cell_x, cell_y = cell[..., 0].astype(np.int64), cell[..., 1].astype(np.int64)
     # Ramps
-    n00 = np.sum(grid * g00, 2)
-    n10 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1])) * g10, 2)
-    n01 = np.sum(np.dstack((grid[:, :, 0], grid[:, :, 1] - 1)) * g01, 2)
-    n11 = np.sum(np.dstack((grid[:, :, 0] - 1, grid[:, :, 1] - 1)) * g11, 2)
+    n00 = np.sum(grid * hashed_gradients(cell_x, cell_y, seed), -1)
+    n10 = np.sum(np.stack((grid[..., 0] - 1, grid[..., 1]), -1) * hashed_gradients(cell_x + 1, cell_y, seed), -1)
+    n01 = np.sum(np.stack((grid[..., 0], grid[..., 1] - 1), -1) * hashed_gradients(cell_x, cell_y + 1, seed), -1)
+    n11 = np.sum(np.stack((grid[..., 0] - 1, grid[..., 1] - 1), -1) * hashed_gradients(cell_x + 1, cell_y + 1, seed), -1)
     # Interpolation
     t = smoothen(grid)
-    n0 = n00 * (1 - t[:, :, 0]) + t[:, :, 0] * n10
-    n1 = n01 * (1 - t[:, :, 0]) + t[:, :, 0] * n11
-    p = np.sqrt(2) * ((1 - t[:, :, 1]) * n0 + t[:, :, 1] * n1)[:shape_orig[0], :shape_orig[1]]
-    return p
+    n0 = n00 * (1 - t[..., 0]) + t[..., 0] * n10
+    n1 = n01 * (1 - t[..., 0]) + t[..., 0] * n11
+    return np.sqrt(2) * ((1 - t[..., 1]) * n0 + t[..., 1] * n1)
+
+
+def generate_fractal_noise_2d(shape, res, octaves=1, persistence=0.4, show=False, tile_rows=None, seed=None,
+                              workers=1, executor=ThreadPoolExecutor, montage=None, out=None, dtype=None):
+    """ Sum of perlin octaves; with a seed the gradients are hashed, otherwise
+        drawn from the global RNG. Octaves are evaluated concurrently by `workers`
+        threads (or processes with executor=ProcessPoolExecutor), the result does not
+        depend on their number.
+        show / montage: display the octaves and their sum, or save them as one PNG
+        montage to this path; matplotlib is not touched otherwise
+        out / dtype: as for generate_perlin_noise_2d, octaves are computed in dtype too """
+    octaves_res = [(2 ** p * res[0], 2 ** p * res[1]) for p in range(octaves)]
+    # all gradient tables are made up front and in order, the RNG stream stays the same
+    if seed is None:
+        gradients = [perlin_gradients(octave_res) for octave_res in octaves_res]
+    else:
+        gradients = [lattice_gradients(octave_res, octave_seed(seed, p)) for p, octave_res in enumerate(octaves_res)]
+
+    if dtype is None:
+        dtype = np.float64 if out is None else out.dtype
+    noise = np.zeros(shape, dtype) if out is None else out
+    noise[...] = 0
+    diagnostics = [] if show or montage else None
+
+    # at most `workers` octaves exist at once, each evaluated into a reused buffer;
+    # worker processes can not write into ours and send theirs back instead
+    in_flight = min(workers, octaves)
+    shared = workers == 1 or executor is ThreadPoolExecutor
+    buffers = [np.empty(shape, dtype) if shared else None for _ in range(in_flight)]
+
+    def submit(pool, p):
+        return pool.submit(generate_perlin_noise_2d, shape, octaves_res[p], gradients[p], tile_rows,
+                           buffers[p % in_flight], dtype)
+
+    def in_order(pool):
+        """ Octaves in order, the next one is only started once the buffer it reuses was summed """
+        pending = deque(submit(pool, p) for p in range(in_flight))
+        for p in range(octaves):
+            yield pending.popleft().result()
+            if p + in_flight < octaves:
+                pending.append(submit(pool, p + in_flight))
+
+    def accumulate(perlins):
+        amplitude = 1
+        for p, perlin in enumerate(perlins):
+            if diagnostics is not None:
+                diagnostics.append((perlin.copy(), f'Octave {p + 1} {shape} {octaves_res[p][0]} {octaves_res[p][1]}'))
+            perlin *= amplitude  # in place, no temporary of the whole shape
+            np.add(noise, perlin, out=noise)
+            amplitude *= persistence
+
+    if workers == 1:
+        accumulate(generate_perlin_noise_2d(shape, octave_res, octave_gradients, tile_rows, buffers[0], dtype)
+                   for octave_res, octave_gradients in zip(octaves_res, gradients))
+    else:
+        with executor(max_workers=workers) as pool:
+            accumulate(in_order(pool))
 
+    if diagnostics is not None:
+        plot_noise(diagnostics + [(noise, 'Sum')], show=show, path=montage)
+
+    return noise
 
-def generate_fractal_noise_2d(shape, res, octaves=1, persistence=0.4, show=False):
-    noise = np.zeros(shape)
-    frequency = 1
-    amplitude = 1
-    plt.subplots(1, octaves + 1, figsize=((2 + octaves) * 5, 5))
-    for p in range(octaves):
-        perlin = generate_perlin_noise_2d(shape, (frequency * res[0], frequency * res[1]))
-        noise += amplitude * perlin
-        frequency *= 2
-        amplitude *= persistence
-        plt.subplot(1, octaves + 1, p + 1)
-        plt.imshow(perlin, cmap='gray')
-        plt.title(f'Octave {p + 1} {shape} {frequency * res[0]} {frequency * res[1]}')
 
-    plt.subplot(1, octaves + 1, octaves + 1)
-    plt.imshow(noise, cmap='gray')
-    plt.title('Sum')
+def plot_noise(images, show=False, path=None):
+    """ Side by side grayscale plots of (image, title) pairs, shown or saved to path """
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=((1 + len(images)) * 5, 5))
+    else:
+        # plain figure without pyplot, saving works without any display
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=((1 + len(images)) * 5, 5))
+
+    for i, (image, title) in enumerate(images):
+        ax = fig.add_subplot(1, len(images), i + 1)
+        ax.imshow(image, cmap='gray')
+        ax.set_title(title)
+
+    if path:
+        fig.savefig(path)
+        print(f'Saved noise montage to: {path}')
     if show:
         plt.show()
+        # delete figure
+        plt.close(fig)
 
-    # delete figure
-    plt.close()
 
+def fractal_noise_at(points, shape, res, octaves=1, persistence=0.4, seed=0):
+    """ generate_fractal_noise_2d(shape, res, ..., seed=seed) evaluated only at
+        grid coordinates points (..., 2), which may be fractional or outside of shape """
+    points = np.asarray(points, dtype=np.float64)
+    noise = np.zeros(points.shape[:-1])
+    frequency = 1
+    amplitude = 1
+    for p in range(octaves):
+        # same lattice spacing as the grid evaluation
+        octave_res = (frequency * res[0], frequency * res[1])
+        scale = np.array((octave_res[0] / shape[0], octave_res[1] / shape[1]))
+        noise += amplitude * perlin_noise_at(points * scale, octave_seed(seed, p))
+        frequency *= 2
+        amplitude *= persistence
     return noise
 
 
@@ -80,13 +227,18 @@ def generate_terrain(dim=100,
                      crater_radius=30,
                      crater_height=100,
                      hole_radius=10,
-                     noise_amplitude=50):
-    # base terrain grid
-    terrain = np.zeros((dim, dim), dtype=np.float32)
-
-    # perlin noise
-    terrain += noise_amplitude * generate_fractal_noise_2d(terrain.shape, res=(1, 1),
-                                                           octaves=5, persistence=0.3)
+                     noise_amplitude=50,
+                     seed=None,
+                     workers=1,
+                     noise_montage=None,
+                     dtype=np.float32):
+    # base terrain grid, noise is computed in dtype straight into it
+    terrain = np.empty((dim, dim), dtype=dtype)
+
+    # perlin noise, reproducible point by point with fractal_noise_at when seeded (in float64)
+    generate_fractal_noise_2d(terrain.shape, res=(1, 1), octaves=5, persistence=0.3, seed=seed,
+                              workers=workers, montage=noise_montage, out=terrain)
+    terrain *= noise_amplitude
     lava_height, lava, terrain = generate_crater(crater_center, crater_height, crater_radius,
                                                  hole_radius, terrain)
 
@@ -122,33 +274,367 @@ def generate_crater(crater_center, crater_height, crater_radius, hole_radius, te
                 if dist < hole_radius:
                     terrain[i, j] = 0
 
-    ''' Crater generation - vectorized version '''
-    # precompute distances from crater center
-    x_low, x_high = crater_center[0] - r_big, crater_center[0] + r_big
-    y_low, y_high = crater_center[1] - r_big, crater_center[1] + r_big
-    dists = np.sqrt((np.arange(x_low, x_high)[:, None] - crater_center[0]) ** 2 + (
-            np.arange(y_low, y_high)[None, :] - crater_center[1]) ** 2)
-    # compute crater height
-    crater = crater_height * np.exp(-dists / crater_radius)
-    # shift to start at 0
-    crater -= np.min(crater)
-    # between hole_radius and hole_radius + 5
-    crater_edge_idx = np.logical_and(dists > hole_radius, dists < hole_radius + 5)
-    crater_inside = np.argwhere(
-        dists < hole_radius)  # needs clamping of the range to fit in the ground, assume this is not a problem for now
-    # hole in crater
-    crater[dists < hole_radius] = 0
-    # terrain[min_x:max_x, min_y:max_y] += crater
-    terrain[x_low:x_high, y_low:y_high] += crater
-    # shift ground to positive values
+    ''' Crater generation - vectorized version, shared with stamp_features '''
+    lava_heights, lavas, terrain = stamp_features(terrain, craters=([crater_center], [crater_height],
+                                                                    [crater_radius], [hole_radius]))
+    return lava_heights[0], lavas[0], terrain
+
+
+# kinds of terrain features stamped by stamp_features
+CRATER, CONE, DEPRESSION = 0, 1, 2
+
+
+def stamp_features(terrain, craters=None, cones=None, depressions=None, bucket_size=64):
+    """ Add many craters, cones and depressions to the terrain in a single pass.
+        craters are arrays (centers, heights, radii, hole_radii), cones (centers, heights, radii)
+        and depressions (centers, depths, radii), centers are grid cells (x, y).
+        The grid is split in buckets of bucket_size cells, each bucket only evaluates the
+        features overlapping it. Returns the lava height and lava cells of every crater,
+        in the order given, like generate_crater """
+    kinds, centers, heights, radii, holes, extents = [], [], [], [], [], []
+    for kind, features in ((CRATER, craters), (CONE, cones), (DEPRESSION, depressions)):
+        if features is None:
+            continue
+        center, height, radius = features[:3]
+        center = np.rint(np.asarray(center, dtype=np.float64).reshape(-1, 2)).astype(int)
+        height, radius = np.broadcast_to(height, len(center)), np.broadcast_to(radius, len(center))
+        if kind == CRATER:
+            hole, extent = np.broadcast_to(features[3], len(center)), (radius * 4).astype(int)
+        else:
+            # cones and depressions vanish at their radius
+            hole, extent = np.zeros(len(center)), np.ceil(radius).astype(int) + 1
+        kinds.append(np.full(len(center), kind))
+        centers.append(center), heights.append(height), radii.append(radius)
+        holes.append(hole), extents.append(extent)
+    if not kinds:
+        return [], [], terrain
+    kind, center, height, radius, hole, extent = (np.concatenate(a) for a in (kinds, centers, heights, radii,
+                                                                                holes, extents))
+    # craters start at 0 on the border of their square window (its corners are the farthest)
+    base = np.where(kind == CRATER, height * np.exp(-np.sqrt(extent ** 2 + extent ** 2) / radius), 0)
+
+    # spatial index: features listed in every bucket their window [center - extent, center + extent) overlaps
+    dim_x, dim_y = terrain.shape
+    low = np.maximum(center - extent[:, None], 0)
+    high = np.minimum(center + extent[:, None], (dim_x, dim_y))
+    buckets = {}
+    for feature in np.flatnonzero(np.all(low < high, axis=1)):
+        for bx in range(low[feature, 0] // bucket_size, (high[feature, 0] - 1) // bucket_size + 1):
+            for by in range(low[feature, 1] // bucket_size, (high[feature, 1] - 1) // bucket_size + 1):
+                buckets.setdefault((bx, by), []).append(feature)
+
+    for (bx, by), features in buckets.items():
+        x_low, y_low = bx * bucket_size, by * bucket_size
+        x_high, y_high = min(x_low + bucket_size, dim_x), min(y_low + bucket_size, dim_y)
+        f = np.array(features)
+        # one layer per overlapping feature
+        dx = np.arange(x_low, x_high)[None, :, None] - center[f, 0, None, None]
+        dy = np.arange(y_low, y_high)[None, None, :] - center[f, 1, None, None]
+        dists = np.sqrt(dx ** 2 + dy ** 2)
+        e, r, h = extent[f, None, None], radius[f, None, None], height[f, None, None]
+        in_window = (dx >= -e) & (dx < e) & (dy >= -e) & (dy < e)
+
+        crater = h * np.exp(-dists / r) - base[f, None, None]
+        crater[dists < hole[f, None, None]] = 0  # hole in crater
+        cone = h * np.maximum(1 - dists / r, 0)
+        depression = -h * smoothen(np.clip(1 - dists / r, 0, 1))
+        stamp = np.select([kind[f, None, None] == CRATER, kind[f, None, None] == CONE], [crater, cone], depression)
+        terrain[x_low:x_high, y_low:y_high] += np.sum(np.where(in_window, stamp, 0), axis=0)
+
+    # shift ground, as generate_crater always did
     shift = np.min(terrain)
     terrain += shift
-    # crater properties are calculated based on the terrain with the crater placed
-    crater_placed = terrain[x_low:x_high, y_low:y_high]
-    crater_edge_placed = crater_placed[crater_edge_idx]
-    lava = crater_inside + np.array([x_low, y_low])
-    lava_height = np.mean(crater_edge_placed) - 0.5  # safety margin
-    return lava_height, lava, terrain
+
+    # crater properties are calculated based on the terrain with all features placed
+    lava_heights, lavas = [], []
+    for feature in np.flatnonzero(kind == CRATER):
+        (cx, cy), r_hole = center[feature], hole[feature]
+        e = min(int(np.ceil(r_hole)) + 5, extent[feature])  # the rim is within hole_radius + 5
+        x_low, x_high = max(cx - e, 0), min(cx + e, dim_x)
+        y_low, y_high = max(cy - e, 0), min(cy + e, dim_y)
+        dists = np.sqrt((np.arange(x_low, x_high)[:, None] - cx) ** 2 + (np.arange(y_low, y_high)[None, :] - cy) ** 2)
+        crater_edge = terrain[x_low:x_high, y_low:y_high][np.logical_and(dists > r_hole, dists < r_hole + 5)]
+        lavas.append(np.argwhere(dists < r_hole) + np.array([x_low, y_low]))
+        lava_heights.append(np.mean(crater_edge) - 0.5)  # safety margin
+    return lava_heights, lavas, terrain
+
+
+def compute_normals_grid(terrain, out=None, dtype=None):
+    """ Per-cell normals of a heightmap, derived from its gradient.
+        out: preallocated (dim_x - 1, dim_z - 1, 3) array to write them into
+        dtype: precision of the gradients and normals, the heights' by default """
+    dim_x, dim_z = terrain.shape
+    grad_x, grad_z = np.gradient(np.asarray(terrain, dtype))
+
+    if out is None:
+        out = np.empty((dim_x - 1, dim_z - 1, 3), grad_x.dtype)
+    out[:, :, 0] = grad_x[:dim_x - 1, :dim_z - 1]
+    # y-component of the normal is 1 - but the specific value is not important, as it will get normalized
+    out[:, :, 1] = 1
+    out[:, :, 2] = grad_z[:dim_x - 1, :dim_z - 1]
+    out /= np.linalg.norm(out, axis=2)[:, :, None]
+    return out
+
+
+def update_normals_grid(terrain, normals_grid, x_low, x_high, z_low, z_high):
+    """ Recompute in place the normals affected by a change of terrain[x_low:x_high, z_low:z_high],
+        identical to compute_normals_grid. Returns the rectangle of normals updated """
+    dim_x, dim_z = terrain.shape
+    # gradients change one point around the edit, and need one more point of context
+    nx_low, nx_high = max(x_low - 1, 0), min(x_high + 1, dim_x - 1)
+    nz_low, nz_high = max(z_low - 1, 0), min(z_high + 1, dim_z - 1)
+    wx_low, wz_low = max(x_low - 2, 0), max(z_low - 2, 0)
+    window = terrain[wx_low:min(x_high + 2, dim_x), wz_low:min(z_high + 2, dim_z)]
+    grad_x, grad_z = np.gradient(window)
+    normals = np.stack((grad_x, np.ones_like(grad_x), grad_z), axis=2)
+    normals = normals / np.linalg.norm(normals, axis=2)[:, :, None]
+    normals_grid[nx_low:nx_high, nz_low:nz_high] = normals[nx_low - wx_low:nx_high - wx_low,
+                                                           nz_low - wz_low:nz_high - wz_low]
+    return nx_low, nx_high, nz_low, nz_high
+
+
+def apply_brush(terrain, kind, center, radius, strength=1.0, target=None):
+    """ Sculpt the terrain in place with a round brush centered on grid point (x, z):
+        'raise' or 'lower' by strength, 'flatten' towards target (height at the center
+        by default) with strength in [0, 1], or dig a 'crater' of depth strength with a rim.
+        Returns the touched rectangle (x_low, x_high, z_low, z_high), None if off the map """
+    cx, cz = center
+    x_low, x_high = max(int(np.floor(cx - radius)), 0), min(int(np.ceil(cx + radius)) + 1, terrain.shape[0])
+    z_low, z_high = max(int(np.floor(cz - radius)), 0), min(int(np.ceil(cz + radius)) + 1, terrain.shape[1])
+    if x_low >= x_high or z_low >= z_high:
+        return None
+
+    window = terrain[x_low:x_high, z_low:z_high]
+    u = np.sqrt((np.arange(x_low, x_high)[:, None] - cx) ** 2 + (np.arange(z_low, z_high)[None, :] - cz) ** 2) / radius
+    falloff = smoothen(np.clip(1 - u, 0, 1))
+    if kind == 'raise':
+        window += strength * falloff
+    elif kind == 'lower':
+        window -= strength * falloff
+    elif kind == 'flatten':
+        if target is None:
+            target = terrain[int(np.clip(round(cx), 0, terrain.shape[0] - 1)), int(np.clip(round(cz), 0, terrain.shape[1] - 1))]
+        window += (target - window) * min(strength, 1) * falloff
+    elif kind == 'crater':
+        bowl = smoothen(np.clip(1 - u / 0.6, 0, 1))
+        rim = 0.4 * np.sin(np.pi * np.clip((u - 0.4) / 0.6, 0, 1)) ** 2
+        window += strength * (rim - bowl)
+    else:
+        raise ValueError(f'Unknown brush: {kind}')
+    return x_low, x_high, z_low, z_high
+
+
+# grid cell corners (dx, dz), the vertices look like this:
+# 1---2
+# | / |
+# 3---4
+# triangle vertices go ``counter-clockwise``
+# first triangle is top-left 1-3-2
+# second one is bottom-right 2-3-4
+CELL_VERTEX_OFFSETS = np.array([(0, 0), (0, 1), (1, 0), (1, 0), (0, 1), (1, 1)])
+# normals are read with corners 2 and 3 swapped (kept from the original per-cell loop)
+CELL_NORMAL_OFFSETS = np.array([(0, 0), (1, 0), (0, 1), (0, 1), (1, 0), (1, 1)])
+
+
+def build_terrain_mesh(terrain, normals_grid):
+    """ Triangle soup (vertices, normals) for a heightmap, 6 vertices per cell.
+        x is left to right, y is up, z is forward """
+    cells_x, cells_z = terrain.shape[0] - 2, terrain.shape[1] - 2
+    x = np.arange(cells_x, dtype=np.float32)[:, None]
+    z = np.arange(cells_z, dtype=np.float32)[None, :]
+
+    # one row per cell, every corner is a shifted view of the grid
+    vertices = np.empty((cells_x, cells_z, 6, 3), dtype=np.float32)
+    normals = np.empty((cells_x, cells_z, 6, 3), dtype=np.float32)
+    for corner, ((dx, dz), (nx, nz)) in enumerate(zip(CELL_VERTEX_OFFSETS, CELL_NORMAL_OFFSETS)):
+        vertices[:, :, corner, 0] = x + dx
+        vertices[:, :, corner, 1] = terrain[dx:dx + cells_x, dz:dz + cells_z]
+        vertices[:, :, corner, 2] = z + dz
+        normals[:, :, corner] = normals_grid[nx:nx + cells_x, nz:nz + cells_z]
+    return vertices.reshape(-1, 3), normals.reshape(-1, 3)
+
+
+def build_terrain_grid_mesh(terrain, normals_grid, out=None):
+    """ Indexed mesh (vertices, normals, indices) for a heightmap: one shared
+        vertex per grid point, triangles in the same order as build_terrain_mesh.
+        out: preallocated float32 ((dim_x - 1) * (dim_z - 1), 3) array for the vertices """
+    dim_x, dim_z = terrain.shape[0] - 1, terrain.shape[1] - 1
+    # filled column by column, without int64 or float64 intermediates of the whole grid
+    vertices = np.empty((dim_x * dim_z, 3), np.float32) if out is None else out
+    grid = vertices.reshape(dim_x, dim_z, 3)
+    grid[:, :, 0] = np.arange(dim_x)[:, None]
+    grid[:, :, 1] = terrain[:dim_x, :dim_z]
+    grid[:, :, 2] = np.arange(dim_z)[None, :]
+    normals = np.asarray(normals_grid[:dim_x, :dim_z], dtype=np.float32).reshape(-1, 3)
+
+    return vertices, normals, build_grid_indices(dim_x, dim_z)
+
+
+def build_grid_indices(dim_x, dim_z):
+    """ Triangle indices of a dim_x x dim_z grid of vertices stored row by row """
+    # 16 bit indices whenever the vertex count allows it, halves the index buffer
+    index_type = np.uint16 if dim_x * dim_z <= 2 ** 16 else np.uint32
+    first = np.arange(dim_x - 1)[:, None] * dim_z + np.arange(dim_z - 1)
+    corners = [first + dx * dim_z + dz for dx, dz in CELL_VERTEX_OFFSETS]
+    return np.stack(corners, axis=2).reshape(-1).astype(index_type)
+
+
+def build_rtin_levels(size):
+    """ Right triangulated irregular network over a (size + 1)^2 grid, size a power of 2.
+        Returns per level the flat grid indices (a, b, c) of its triangles: hypotenuse a-b,
+        right angle at c. Level 0 splits the square along its diagonal, every triangle of
+        level l is split at its hypotenuse midpoint into two of level l + 1 """
+    width = size + 1
+    # two root triangles sharing the (0, 0) - (size, size) diagonal
+    a = np.array([size * width + size, 0], np.int32)
+    b = np.array([0, size * width + size], np.int32)
+    c = np.array([size, size * width], np.int32)
+    levels = []
+    for _ in range(2 * int(np.log2(size))):  # leaves are half cells
+        levels.append((a, b, c))
+        m = (a + b) // 2  # flat indices are linear in the grid coordinates
+        a, b, c = np.concatenate((c, b)), np.concatenate((a, c)), np.concatenate((m, m))
+    return levels
+
+
+def build_rtin_mesh(terrain, normals_grid, max_error=1.0):
+    """ Indexed mesh (vertices, normals, indices) of the heightmap simplified into a right
+        triangulated irregular network (RTIN, as in mapbox/martini): triangles are split
+        until the surface is guaranteed within max_error of every grid point, covering
+        the same grid points as build_terrain_grid_mesh """
+    dim_x, dim_z = terrain.shape[0] - 1, terrain.shape[1] - 1
+    last_x, last_z = dim_x - 1, dim_z - 1
+    size = 2 ** int(np.ceil(np.log2(max(last_x, last_z, 2))))
+    width = size + 1
+    heights = np.pad(np.asarray(terrain[:dim_x, :dim_z], np.float32),
+                     ((0, width - dim_x), (0, width - dim_z)), mode='edge').reshape(-1)
+    levels = build_rtin_levels(size)
+
+    def outside(*flats):
+        """ Per corner, whether it is past the real grid """
+        return [(flat // width > last_x) | (flat % width > last_z) for flat in flats]
+
+    # error bound of the triangles, stored at their hypotenuse midpoint: inside a child, the
+    # parent differs from the child by at most the midpoint error, the two errors add up
+    # (martini keeps the max of both, which can overshoot max_error)
+    errors = np.zeros(width * width, np.float32)
+    for depth in range(len(levels) - 1, -1, -1):
+        a, b, c = levels[depth]
+        m = (a + b) // 2
+        error = np.abs((heights[a] + heights[b]) / 2 - heights[m])
+        if depth < len(levels) - 1:
+            error += np.maximum(errors[(c + a) // 2], errors[(b + c) // 2])
+        # triangles across the border of the real grid are always split, down to cells inside or outside
+        corners_out = outside(a, b, c)
+        x_min = np.minimum(np.minimum(a // width, b // width), c // width)
+        z_min = np.minimum(np.minimum(a % width, b % width), c % width)
+        across = np.any(corners_out, axis=0) & (x_min < last_x) & (z_min < last_z)
+        error[across] = np.inf
+        np.maximum.at(errors, m, error)
+
+    # top down, keep the triangles that are accurate enough
+    kept = []
+    a, b, c = levels[0]
+    for depth in range(len(levels) + 1):
+        m = (a + b) // 2
+        split = errors[m] > max_error if depth < len(levels) else np.zeros(len(a), bool)
+        kept.append(np.stack((a[~split], b[~split], c[~split]), axis=1))
+        a, b, c, m = a[split], b[split], c[split], m[split]
+        a, b, c = np.concatenate((c, b)), np.concatenate((a, c)), np.concatenate((m, m))
+    triangles = np.concatenate(kept)
+    triangles = triangles[~outside(triangles)[0].any(axis=1)]
+
+    # same winding as the dense mesh: (x, z) corners (0, 0), (0, 1), (1, 0)
+    x, z = triangles // width, triangles % width
+    cross = (x[:, 1] - x[:, 0]) * (z[:, 2] - z[:, 0]) - (z[:, 1] - z[:, 0]) * (x[:, 2] - x[:, 0])
+    triangles[cross > 0] = triangles[cross > 0][:, [0, 2, 1]]
+
+    used, indices = np.unique(triangles, return_inverse=True)
+    x, z = used // width, used % width
+    vertices = np.stack((x, heights[used], z), axis=1).astype(np.float32)
+    normals = np.asarray(normals_grid[x, z], dtype=np.float32)
+    index_type = np.uint16 if len(vertices) <= 2 ** 16 else np.uint32
+    return vertices, normals, indices.reshape(-1).astype(index_type)
+
+
+def build_lava_mesh(crater_inside, crater_edge_height, max_width=1):
+    """ Flat lava surface over the cells inside the crater, greedy meshed into rectangles.
+        Cells are merged into runs along z, then equal runs of neighbouring x columns into
+        rectangles at most max_width columns wide (None for no limit): lava.vert waves the
+        surface along position.x, and 1 keeps a vertex on every integer x like one quad per
+        cell did. Returns vertices and triangle indices, the normal is up everywhere """
+    cells = np.unique(np.asarray(crater_inside, dtype=int).reshape(-1, 2), axis=0)  # sorted by x, then z
+    if not len(cells):  # no hole in the crater, no lava
+        return np.empty((0, 3), np.float32), np.empty(0, np.uint16)
+    x, z = cells.T
+
+    # runs of consecutive cells along z in a column
+    starts = np.flatnonzero(np.r_[True, (x[1:] != x[:-1]) | (z[1:] != z[:-1] + 1)])
+    ends = np.r_[starts[1:], len(cells)] - 1
+    run_x, run_z0, run_z1 = x[starts], z[starts], z[ends] + 1
+
+    # equal runs of neighbouring columns are merged, up to max_width of them
+    order = np.lexsort((run_x, run_z1, run_z0))
+    run_x, run_z0, run_z1 = run_x[order], run_z0[order], run_z1[order]
+    new_group = np.r_[True, (run_z0[1:] != run_z0[:-1]) | (run_z1[1:] != run_z1[:-1]) | (run_x[1:] != run_x[:-1] + 1)]
+    group = np.cumsum(new_group) - 1
+    in_group = np.arange(len(run_x)) - np.flatnonzero(new_group)[group]
+    first = new_group | (in_group % max_width == 0) if max_width else new_group
+    rectangles = np.flatnonzero(first)
+    x0, z0, z1 = run_x[rectangles], run_z0[rectangles], run_z1[rectangles]
+    x1 = np.maximum.reduceat(run_x, rectangles) + 1 if len(rectangles) else x0
+
+    # corners v1 (x0, z0), v2 (x1, z0), v3 (x0, z1), v4 (x1, z1), triangles (v1, v3, v2) and (v2, v3, v4)
+    corners_x = np.stack((x0, x1, x0, x1), axis=1).reshape(-1)
+    corners_z = np.stack((z0, z0, z1, z1), axis=1).reshape(-1)
+    vertices = np.stack((corners_x, np.full(len(corners_x), crater_edge_height), corners_z), axis=1)
+    index_type = np.uint16 if len(vertices) <= 2 ** 16 else np.uint32
+    indices = (np.arange(len(rectangles))[:, None] * 4 + np.array([0, 2, 1, 1, 2, 3])).reshape(-1)
+    return vertices.astype(np.float32), indices.astype(index_type)
+
+
+# version of the arrays made by bake_terrain, part of the terrain cache keys
+TERRAIN_FORMAT = 4
+
+# volcano shown by the viewer
+VOLCANO = dict(dim=300, crater_height=40, hole_radius=10, crater_radius=30, noise_amplitude=70, seed=98)
+
+
+def bake_terrain(dim=100,
+                 crater_center=None,
+                 crater_radius=30,
+                 crater_height=100,
+                 hole_radius=10,
+                 noise_amplitude=50,
+                 seed=0,
+                 workers=1,
+                 max_error=None):
+    """ Generate a terrain and every array the viewer draws it from.
+        With max_error, the ground mesh is simplified within that vertical error """
+    terrain, crater_inside, crater_edge_height = generate_terrain(dim=dim,
+                                                                  crater_center=crater_center,
+                                                                  crater_radius=crater_radius,
+                                                                  crater_height=crater_height,
+                                                                  hole_radius=hole_radius,
+                                                                  noise_amplitude=noise_amplitude,
+                                                                  seed=seed,
+                                                                  workers=workers)
+
+    # compute normals
+    normals_grid = compute_normals_grid(terrain)
+
+    ''' OpenGL mesh '''
+    print('Creating mesh...')
+    if max_error is None:
+        vertices, normals, indices = build_terrain_grid_mesh(terrain, normals_grid)
+    else:
+        vertices, normals, indices = build_rtin_mesh(terrain, normals_grid, max_error)
+
+    ''' Lava '''
+    vertices_lava, indices_lava = build_lava_mesh(crater_inside, crater_edge_height)
+
+    return dict(ground_vertices=vertices, ground_normals=normals, ground_indices=indices, ground_grid=terrain,
+                lava_vertices=vertices_lava, lava_indices=indices_lava)
 
 
 def save_i(path, data=None, overwrite=False, **data_dict):
@@ -163,7 +649,28 @@ def save_i(path, data=None, overwrite=False, **data_dict):
         print(f'Saved to: {path}.npz')
 
 
+def save_baked(path, **arrays):
+    """ Save baked arrays as a directory of raw .npy files, which load_baked memory-maps """
+    makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        # .npy headers are padded to 64 bytes, the data stays aligned when mapped
+        np.save(join(path, name + '.npy'), np.ascontiguousarray(array))
+    print(f'Saved to: {path}')
+
+
+def load_baked(path, mmap=True):
+    """ Baked arrays from a save_baked directory, memory-mapped read-only so they
+        go to the GPU without being copied, or from an older .npz file """
+    if isdir(path):
+        return {name[:-len('.npy')]: np.load(join(path, name), mmap_mode='r' if mmap else None)
+                for name in listdir(path) if name.endswith('.npy')}
+    with np.load(path) as baked:
+        return dict(baked)
+
+
 def plot_terrain(ground):
+    import matplotlib.pyplot as plt
+
     # plot crater 3d surface
     dim_x, dim_y = ground.shape
     fig = plt.figure()
@@ -183,112 +690,8 @@ def plot_terrain(ground):
 
 
 if __name__ == "__main__":
-    # set manual seed - always makes the same crater
-    np.random.seed(98)
-
-    show_plots = False
-    if not show_plots:
-        plt.ioff()
-        # plt.ion()
-
-    ''' Terrain generation '''
-    dim = 300
-    terrain, crater_inside, crater_edge_height = generate_terrain(dim=dim,
-                                                                  crater_height=40,
-                                                                  hole_radius=10,
-                                                                  crater_radius=30,
-                                                                  noise_amplitude=70)
-
-    # compute normals
-    grad = np.gradient(terrain)
-    grad_x, grad_z = grad
-
-    # normals
-    grad_y = np.ones_like(grad_x)
-    normals_grid = np.stack((grad_x, grad_y, grad_z), axis=2)
-    normals_grid = normals_grid / np.linalg.norm(normals_grid, axis=2)[:, :, None]
-    normals_grid = normals_grid[:dim - 1, :dim - 1, :]
-
-    ''' OpenGL mesh '''
-    # indices = []  # unused
-    normals = []
-    vertices = []
-
-    print('Creating mesh...')
-    for x in range(dim - 2):
-        for y in range(dim - 2):
-            # x is left to right
-            # y is up
-            # z is forward
-
-            ''' Vertices '''
-            v1 = np.array([x, terrain[x, y], y])
-            v2 = np.array([x + 1, terrain[x + 1, y], y])
-            v3 = np.array([x, terrain[x, y + 1], y + 1])
-            v4 = np.array([x + 1, terrain[x + 1, y + 1], y + 1])
-
-            vertices.extend([v1, v3, v2] + [v2, v3, v4])
-
-            n1 = normals_grid[x, y, :]
-            n2 = normals_grid[x, y + 1, :]
-            n3 = normals_grid[x + 1, y, :]
-            n4 = normals_grid[x + 1, y + 1, :]
-
-            normals.extend([n1, n3, n2] + [n2, n3, n4])
-
-            ''' Indices '''
-            i1 = y * dim + x
-            i2 = y * dim + x + 1
-            i3 = (y + 1) * dim + x
-            i4 = (y + 1) * dim + x + 1
-
-            # the vertices look like this:
-            # 1---2
-            # | / |
-            # 3---4
-
-            # triangle vertices go ``counter-clockwise``
-            # first triangle is top-left 1-3-2
-            # second one is bottom-right 2-3-4
-
-            # indices.extend([i1, i2, i3] + [i2, i4, i3])
-
-            ''' Normals '''
-            # how many per vertex? 1
-            # n1 = np.cross(v2 - v1, v3 - v1)
-            # n2 = np.cross(v4 - v2, v3 - v2)
-
-            # y-component of the normal is 1 - but the specific value is not important, as it will get normalized
-            # x-component = grad_x[x, y]
-            # z-component = grad_y[x, y]
-
-    ''' Lava '''
-
-    vertices_lava = []
-    normals_lava = []
-
-    for x, z in crater_inside:
-        # crater_inside has [x, z], crater_edge_height has [y]
-        v1 = np.array([x, crater_edge_height, z])
-        v2 = np.array([x + 1, crater_edge_height, z])
-        v3 = np.array([x, crater_edge_height, z + 1])
-        v4 = np.array([x + 1, crater_edge_height, z + 1])
-
-        vertices_lava.extend([v1, v3, v2] + [v2, v3, v4])
-
-        n1 = np.array([0, 1, 0])
-        # normals are the same for all vertices
-        normals_lava.extend([n1, n1, n1] + [n1, n1, n1])
-
-    ''' Save all terrain data to npz '''
-    vertices = np.array(vertices, dtype=np.float32)
-    normals = np.array(normals, dtype=np.float32)
-
-    vertices_lava = np.array(vertices_lava, dtype=np.float32)
-    normals_lava = np.array(normals_lava, dtype=np.float32)
-
-    save_i('assets/terrain', overwrite=True,
-           ground_vertices=vertices, ground_normals=normals, ground_grid=terrain,
-           lava_vertices=vertices_lava, lava_normals=normals_lava)
+    # fixed seed - always makes the same crater
+    ''' Save all terrain data as a directory of .npy files, memory-mapped by load_baked '''
+    save_baked('assets/terrain', **bake_terrain(**VOLCANO))
 
     print('Done')
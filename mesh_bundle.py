@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Precompiled meshes: the assimp import of a model written once as a binary bundle
+next to it, which load() memory-maps instead of importing the model again.
+Convert models with: python mesh_bundle.py assets/*.obj
+"""
+# standard library
+import argparse
+import json
+import os
+import struct
+from os.path import dirname, exists, getmtime, join, relpath
+
+# external libraries
+import numpy as np
+
+BUNDLE_SUFFIX = '.bundle'
+BUNDLE_MAGIC = b'MESHBNDL'
+BUNDLE_VERSION = 1
+ALIGNMENT = 64  # every array starts on a cache line
+
+
+def bundle_path(file):
+    return file + BUNDLE_SUFFIX
+
+
+def fresh_bundle(file):
+    """ Bundle of file if one exists and is newer than the file, None otherwise """
+    bundle = bundle_path(file)
+    if exists(bundle) and (not exists(file) or getmtime(bundle) >= getmtime(file)):
+        return bundle
+    return None
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_bundle(path, scene, flags):
+    """ Write a scene from core.import_scene: a fixed header (magic, version, JSON
+        length), the JSON description, then the aligned raw arrays it refers to """
+    arrays, offset = [], 0
+
+    def ref(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        offset = align(offset)
+        arrays.append((offset, array))
+        offset += array.nbytes
+        return dict(offset=arrays[-1][0], dtype=array.dtype.str, shape=array.shape)
+
+    def hierarchy(name, transform, mesh_ids, children):
+        return [name, ref(transform), [int(i) for i in mesh_ids], [hierarchy(*child) for child in children]]
+
+    # texture files relative to the bundle, which then moves with its model
+    directory = dirname(path) or '.'
+    meshes = [dict(attributes={name: ref(data) for name, data in mesh['attributes'].items()},
+                   index=ref(mesh['index']),
+                   uniforms={name: np.asarray(value).tolist() for name, value in mesh['uniforms'].items()},
+                   diffuse_file=mesh['diffuse_file'] and relpath(mesh['diffuse_file'], directory),
+                   bones=mesh['bones'] and dict(names=list(mesh['bones'][0]), offsets=ref(mesh['bones'][1])))
+              for mesh in scene['meshes']]
+    # keyframes as (times, values) array pairs for position, rotation and scale
+    keyframes = {name: [[ref(list(keys.keys())), ref(list(keys.values()))] for keys in channel]
+                 for name, channel in scene['keyframes'].items()}
+    header = json.dumps(dict(flags=int(flags), root=hierarchy(*scene['root']), meshes=meshes, keyframes=keyframes,
+                             faces=int(scene['faces']), animations=int(scene['animations']))).encode()
+    data_start = align(len(BUNDLE_MAGIC) + 8 + len(header))
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(BUNDLE_MAGIC + struct.pack('<II', BUNDLE_VERSION, len(header)) + header)
+        for array_offset, array in arrays:
+            file.seek(data_start + array_offset)
+            file.write(array.tobytes())
+    # a concurrent load never maps half a bundle
+    os.replace(path + '.tmp', path)
+    print(f'Saved to: {path} ({data_start + offset} bytes, {len(arrays)} arrays)')
+
+
+def read_bundle(path, flags=None, tex_file=None):
+    """ Scene of a bundle in the core.import_scene layout, arrays memory-mapped read-only.
+        None if the bundle has another version, was made with other post-process flags,
+        or can not be read: empty, truncated or otherwise damaged bundles are stale too """
+    try:
+        return map_bundle(path, flags, tex_file)
+    except (ValueError, KeyError, TypeError, struct.error, OSError) as exception:
+        print(f'Ignoring unreadable bundle {path}: {exception!r}')
+        return None
+
+
+def map_bundle(path, flags, tex_file):
+    data = np.memmap(path, np.uint8, mode='r')
+    header_start = len(BUNDLE_MAGIC) + 8
+    if data[:len(BUNDLE_MAGIC)].tobytes() != BUNDLE_MAGIC:
+        return None
+    version, length = struct.unpack('<II', data[len(BUNDLE_MAGIC):header_start].tobytes())
+    if version != BUNDLE_VERSION:
+        return None
+    header = json.loads(data[header_start:header_start + length].tobytes())
+    if flags is not None and header['flags'] != int(flags):
+        return None
+    data_start = align(header_start + length)
+
+    def array(ref):
+        start = data_start + ref['offset']
+        dtype = np.dtype(ref['dtype'])
+        count = int(np.prod(ref['shape'], dtype=np.int64))
+        return data[start:start + count * dtype.itemsize].view(dtype).reshape(ref['shape'])
+
+    def hierarchy(name, transform, mesh_ids, children):
+        return name, array(transform), mesh_ids, [hierarchy(*child) for child in children]
+
+    directory = dirname(path) or '.'
+    meshes = [dict(attributes={name: array(ref) for name, ref in mesh['attributes'].items()},
+                   index=array(mesh['index']),
+                   uniforms=mesh['uniforms'],
+                   # as in import_scene, tex_file replaces every material texture
+                   diffuse_file=tex_file or (mesh['diffuse_file'] and join(directory, mesh['diffuse_file'])),
+                   bones=mesh['bones'] and (mesh['bones']['names'], array(mesh['bones']['offsets'])))
+              for mesh in header['meshes']]
+    keyframes = {name: tuple(dict(zip(array(times).tolist(), array(values))) for times, values in channel)
+                 for name, channel in header['keyframes'].items()}
+    return dict(root=hierarchy(*header['root']), keyframes=keyframes, meshes=meshes,
+                faces=header['faces'], animations=header['animations'], resolve_time=0.)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='models to convert, each to <file>' + BUNDLE_SUFFIX)
+    parser.add_argument('--force', action='store_true', help='convert even if the bundle is up to date')
+    args = parser.parse_args()
+
+    # assimp and the texture lookup live in core, only needed to convert
+    from core import import_scene, post_process_flags
+    for model in args.files:
+        if fresh_bundle(model) and not args.force:
+            print(f'Up to date: {bundle_path(model)}')
+            continue
+        scene = import_scene(model, post_process_flags())
+        if scene is not None:
+            write_bundle(bundle_path(model), scene, post_process_flags())
@@ -6,14 +6,14 @@ import numpy as np
 import glfw
 
 # local imports
-from core import Mesh
-from texture import Textured, Texture
+from core import Mesh, PACKED_NORMAL
+from texture_cache import textures, SharedTextured
 from OpenGL import GL as GL
 
 """
 Since texture.py was provided in the labs, we keep it unchanged and add similar functionality to a separate file.
 """
-class TexturedPlaneShaded(Textured):
+class TexturedPlaneShaded(SharedTextured):
     """ Adapted from texture.py """
 
     def __init__(self, shader, tex_file, **uniforms):
@@ -34,7 +34,7 @@ class TexturedPlaneShaded(Textured):
         mesh = Mesh(shader, attributes=dict(position=scaled, normal=normals), index=indices, **uniforms)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
-        texture = Texture(tex_file, self.wrap, *self.filter)
+        texture = textures.acquire(tex_file, self.wrap, *self.filter)
         super().__init__(mesh, diffuse_map=texture)
 
     def key_handler(self, key):
@@ -42,23 +42,30 @@ class TexturedPlaneShaded(Textured):
         self.wrap = next(self.wraps) if key == glfw.KEY_F6 else self.wrap
         self.filter = next(self.filters) if key == glfw.KEY_F7 else self.filter
         if key in (glfw.KEY_F6, glfw.KEY_F7):
-            texture = Texture(self.file, self.wrap, *self.filter)
+            textures.release(self.textures['diffuse_map'])
+            texture = textures.acquire(self.file, self.wrap, *self.filter)
             self.textures.update(diffuse_map=texture)
 
 
-class TexturedMesh(Textured):
+class TexturedMesh(SharedTextured):
     """ Textured object """
 
-    def __init__(self, shader, mesh, tex_file, **uniforms):
+    def __init__(self, shader, mesh, tex_file, index=None, formats=None, **uniforms):
         self.wrap, self.filter = GL.GL_REPEAT, (GL.GL_NEAREST, GL.GL_NEAREST)
         self.file = tex_file
 
         # setup plane mesh to be textured
-        # no indices
-        mesh = Mesh(shader, attributes=dict(position=mesh, normal=uniforms['normals']), **uniforms)
+        # optional indices, drawn as a triangle soup without them
+        # optional normals, for shaders that derive them
+        attributes = dict(position=mesh)
+        if uniforms.get('normals') is not None:
+            attributes.update(normal=uniforms['normals'])
+        # normals packed in 4 bytes unless told otherwise
+        formats = dict(normal=PACKED_NORMAL) if formats is None else formats
+        mesh = Mesh(shader, attributes=attributes, index=index, formats=formats, **uniforms)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
-        texture = Texture(tex_file, self.wrap, *self.filter)
+        texture = textures.acquire(tex_file, self.wrap, *self.filter)
         super().__init__(mesh, diffuse_map=texture)
 
 
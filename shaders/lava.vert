@@ -7,7 +7,9 @@ uniform mat4 projection;
 uniform float time;
 
 in vec3 position;
-in vec3 normal;
+
+// lava is flat, the same normal everywhere
+const vec3 normal = vec3(0, 1, 0);
 
 in vec2 tex_coord;
 
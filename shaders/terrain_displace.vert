@@ -0,0 +1,55 @@
+#version 330 core
+
+uniform mat4 model;
+uniform mat4 view;
+uniform mat4 projection;
+
+// heightmap, texel (z, x) holds the height of grid point (x, z)
+uniform sampler2D height_map;
+
+// flat patch placement on the grid: first grid point and spacing of patch vertices
+uniform vec2 patch_origin;
+uniform float patch_step;
+// skirt vertices are pulled down by this much, hiding cracks between levels of detail
+uniform float skirt_depth;
+
+in vec3 position;                // patch point (i, j), 1 on skirt vertices
+
+out vec2 frag_tex_coords;
+
+out vec3 w_position, w_normal;   // in world coordinates
+out float distance;              // distance from camera to vertex
+mat3 nit;
+
+
+float height(ivec2 grid_point) {
+    return texelFetch(height_map, grid_point.yx, 0).r;
+}
+
+void main() {
+    ivec2 last = textureSize(height_map, 0).yx - 1;
+    // points past the end of the map collapse onto its edge
+    ivec2 grid_point = min(ivec2(patch_origin + position.xy * patch_step), last);
+
+    // displacement
+    vec3 displaced = vec3(grid_point.x, height(grid_point) - position.z * skirt_depth, grid_point.y);
+
+    // normal from the gradient, central differences inside and one-sided at the edges (as np.gradient)
+    ivec2 low = max(grid_point - 1, ivec2(0));
+    ivec2 high = min(grid_point + 1, last);
+    float grad_x = (height(ivec2(high.x, grid_point.y)) - height(ivec2(low.x, grid_point.y))) / float(high.x - low.x);
+    float grad_z = (height(ivec2(grid_point.x, high.y)) - height(ivec2(grid_point.x, low.y))) / float(high.y - low.y);
+    vec3 normal = normalize(vec3(grad_x, 1, grad_z));
+
+    gl_Position = projection * view * model * vec4(displaced, 1);
+    // texture mapping
+    frag_tex_coords = displaced.xz;
+
+    // shading
+    nit = transpose(inverse(mat3(model)));
+
+    w_position = (model * vec4(displaced, 1)).xyz;
+    w_normal = normalize(nit * normal);
+
+    distance = length(gl_Position.xyz);
+}
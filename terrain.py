@@ -0,0 +1,375 @@
+# standard library
+import sys
+import weakref
+from time import perf_counter
+
+# external libraries
+import numpy as np
+from OpenGL import GL as GL
+import glfw
+
+# local imports
+from core import Mesh, sphere_around, FLOAT, HALF, PACKED_NORMAL, FOG_DISAPPEARING_DISTANCE
+from texture_cache import textures, SharedTextured
+from generate_terrain import build_grid_indices, build_terrain_grid_mesh, compute_normals_grid, apply_brush, \
+    update_normals_grid
+
+
+class HeightTexture:
+    """ Single channel float texture holding a heightmap, indexed [x, z] like ground_grid """
+
+    def __init__(self, grid):
+        self.glid = GL.glGenTextures(1)
+        self.type = GL.GL_TEXTURE_2D
+        self.shape = grid.shape
+        grid = np.ascontiguousarray(grid, np.float32)
+        GL.glBindTexture(self.type, self.glid)
+        # rows of the texture are x, columns are z
+        GL.glTexImage2D(self.type, 0, GL.GL_R32F, grid.shape[1], grid.shape[0],
+                        0, GL.GL_RED, GL.GL_FLOAT, grid)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+
+    def update(self, heights, x=0, z=0):
+        """ Upload a block of heights whose first sample is grid point (x, z) """
+        heights = np.ascontiguousarray(heights, np.float32)
+        GL.glBindTexture(self.type, self.glid)
+        GL.glTexSubImage2D(self.type, 0, z, x, heights.shape[1], heights.shape[0],
+                           GL.GL_RED, GL.GL_FLOAT, heights)
+
+    def __del__(self):  # delete GL texture from GPU when object dies
+        GL.glDeleteTextures(self.glid)
+
+
+class HeightmapTerrain(SharedTextured):
+    """ Terrain displaced on the GPU: a flat grid mesh is lifted by the heightmap
+        texture and shaded with normals derived in the vertex shader """
+
+    # flat grid meshes per shader then size, shared by the terrains drawing them:
+    # a grid goes with its last terrain, the grids of a shader with the shader
+    grids = weakref.WeakKeyDictionary()
+
+    def __init__(self, shader, grid, tex_file, **uniforms):
+        self.wrap, self.filter = GL.GL_REPEAT, (GL.GL_NEAREST, GL.GL_NEAREST)
+        self.file = tex_file
+        # a single patch laid over the whole grid
+        self.uniforms = dict(patch_origin=(0, 0), patch_step=1, skirt_depth=0, **uniforms)
+
+        # same vertices as build_terrain_grid_mesh, without heights and normals
+        dim_x, dim_z = grid.shape[0] - 1, grid.shape[1] - 1
+        shader_grids = self.grids.setdefault(shader, weakref.WeakValueDictionary())
+        flat_grid = shader_grids.get((dim_x, dim_z))
+        if flat_grid is None:
+            x, z = np.meshgrid(np.arange(dim_x), np.arange(dim_z), indexing='ij')
+            position = np.stack((x, z, np.zeros_like(x)), axis=2).astype(np.float32).reshape(-1, 3)
+            # grid points are integers, exact in half floats up to 2048
+            position_format = HALF if max(dim_x, dim_z) <= 2048 else FLOAT
+            flat_grid = Mesh(shader, attributes=dict(position=position),
+                             index=build_grid_indices(dim_x, dim_z), formats=dict(position=position_format))
+            shader_grids[dim_x, dim_z] = flat_grid
+
+        # the flat grid mesh knows nothing of the heights, bound the displaced terrain
+        self.bounds = sphere_around((0, np.min(grid), 0), (dim_x, np.max(grid), dim_z))
+
+        # heights are the only per-terrain data on the GPU
+        self.height_map = HeightTexture(grid)
+        texture = textures.acquire(tex_file, self.wrap, *self.filter)
+        super().__init__(flat_grid, diffuse_map=texture, height_map=self.height_map)
+
+    def release(self):
+        """ Release the textures and the shared flat grid """
+        super().release()
+        self.drawable = None
+
+    def update(self, heights, x=0, z=0):
+        """ Edit heights in place, a texture sub-update instead of a new mesh """
+        self.height_map.update(heights, x, z)
+
+    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+        super().draw(primitives=primitives, **{**self.uniforms, **uniforms})
+
+
+class EditableTerrain(SharedTextured):
+    """ Dense terrain mesh sculpted with brushes while it is drawn. Heights and normals
+        are recomputed on the touched rectangle only, and only its rows are uploaded.
+        Keys 1 to 4 raise, lower, flatten or dig a crater at the center of the view """
+
+    BRUSH_KEYS = {glfw.KEY_1: 'raise', glfw.KEY_2: 'lower', glfw.KEY_3: 'flatten', glfw.KEY_4: 'crater'}
+
+    def __init__(self, shader, grid, tex_file, brush_radius=10, brush_strength=2.0, **uniforms):
+        self.wrap, self.filter = GL.GL_REPEAT, (GL.GL_NEAREST, GL.GL_NEAREST)
+        self.file = tex_file
+        self.brush_radius, self.brush_strength = brush_radius, brush_strength
+        self.view, self.model = None, None  # of the last frame, to aim the brush
+
+        self.grid = np.array(grid, np.float32)  # writable copy, baked grids are memory-mapped read only
+        self.normals_grid = compute_normals_grid(self.grid)
+        vertices, normals, indices = build_terrain_grid_mesh(self.grid, self.normals_grid)
+        mesh = Mesh(shader, attributes=dict(position=vertices, normal=normals), index=indices,
+                    usage=GL.GL_DYNAMIC_DRAW, formats=dict(normal=PACKED_NORMAL), **uniforms)
+        texture = textures.acquire(tex_file, self.wrap, *self.filter)
+        super().__init__(mesh, diffuse_map=texture)
+
+    def brush(self, kind, center, radius=None, strength=None, target=None):
+        """ Apply a brush (see apply_brush) at grid point center and upload the changed rows """
+        start = perf_counter()
+        radius = self.brush_radius if radius is None else radius
+        strength = self.brush_strength if strength is None else strength
+        touched = apply_brush(self.grid, kind, center, radius, strength, target)
+        if touched is None:
+            return
+        # normals cover the edit and one more point around it, clipped to the mesh vertices
+        x_low, x_high, z_low, z_high = update_normals_grid(self.grid, self.normals_grid, *touched)
+        if x_low >= x_high or z_low >= z_high:
+            return
+
+        # one upload per row of the rectangle, a single one when rows are complete
+        vertex_array = self.drawable.vertex_array
+        dim_z = self.normals_grid.shape[1]
+        full_rows = z_low == 0 and z_high == dim_z
+        spans = [(x_low, x_high)] if full_rows else [(x, x + 1) for x in range(x_low, x_high)]
+        sent = 0
+        for first_row, last_row in spans:
+            x, z = np.meshgrid(np.arange(first_row, last_row), np.arange(z_low, z_high), indexing='ij')
+            positions = np.stack((x, self.grid[x, z], z), axis=2).reshape(-1, 3)
+            first = first_row * dim_z + z_low
+            sent += vertex_array.update('position', positions, first)
+            sent += vertex_array.update('normal', self.normals_grid[first_row:last_row, z_low:z_high].reshape(-1, 3), first)
+
+        # grow the culling bounds if the edit went past them
+        edited = self.grid[x_low:x_high, z_low:z_high]
+        low, high = (np.array(corner) for corner in vertex_array.aabb)
+        low[1], high[1] = min(low[1], edited.min()), max(high[1], edited.max())
+        vertex_array.aabb = low, high
+        self.drawable.bounds = sphere_around(low, high)
+        print(f'Brush {kind}: {x_high - x_low} x {z_high - z_low} vertices, {sent / 1024:.1f} kB in '
+              f'{2 * len(spans)} uploads, {(perf_counter() - start) * 1000:.1f} ms')
+
+    def aim(self):
+        """ Grid point (x, z) under the center of the view, None when it misses the terrain """
+        if self.view is None:
+            return None
+        to_terrain = np.linalg.inv(self.model) @ np.linalg.inv(self.view)
+        eye, forward = to_terrain[:3, 3], -to_terrain[:3, 2]  # the camera looks down its -z axis
+        forward = forward / np.linalg.norm(forward)
+        points = eye + np.arange(0, FOG_DISAPPEARING_DISTANCE, 0.5)[:, None] * forward
+        heights, _, outside = HeightField(self.grid).sample(points[:, [0, 2]])
+        below = np.flatnonzero((points[:, 1] <= heights) & ~outside)
+        return points[below[0]][[0, 2]] if len(below) else None
+
+    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+        self.view, self.model = uniforms.get('view'), uniforms.get('model')
+        super().draw(primitives=primitives, **uniforms)
+
+    def key_handler(self, key):
+        if key in self.BRUSH_KEYS:
+            center = self.aim()
+            if center is not None:
+                self.brush(self.BRUSH_KEYS[key], center)
+
+
+def build_patch(cells):
+    """ Flat square patch of cells x cells quads, with a skirt hanging from its border.
+        Returns positions (i, j, skirt) and triangle indices """
+    n = cells + 1
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    top = np.stack((i, j, np.zeros_like(i)), axis=2).reshape(-1, 3)
+
+    # border vertices all around the patch, then the same ones on the skirt
+    ring = np.concatenate((np.arange(n - 1),                         # i = 0
+                           np.arange(n - 1) * n + n - 1,             # j = n - 1
+                           (n - 1) * n + np.arange(n - 1, 0, -1),    # i = n - 1
+                           np.arange(n - 1, 0, -1) * n))             # j = 0
+    skirt = top[ring] + (0, 0, 1)
+    lower = n * n + np.arange(len(ring))
+    a, b = ring, np.roll(ring, -1)
+    a_low, b_low = lower, np.roll(lower, -1)
+    # skirt quads in both windings, they are seen from either side with back face culling
+    walls = np.stack((a, a_low, b, b, a_low, b_low, a, b, a_low, b, b_low, a_low), axis=1)
+
+    positions = np.concatenate((top, skirt)).astype(np.float32)
+    index_type = np.uint16 if len(positions) <= 2 ** 16 else np.uint32
+    indices = np.concatenate((build_grid_indices(n, n), walls.reshape(-1))).astype(index_type)
+    return positions, indices
+
+
+def lod_errors(padded, step):
+    """ Vertical error of every grid point when the grid is only sampled every `step` points """
+    size = padded.shape[0]
+    coarse = padded[::step, ::step]
+    first = np.arange(size) // step
+    last = np.minimum(first + 1, coarse.shape[0] - 1)
+    t = (np.arange(size) % step / step).astype(np.float32)
+    # bilinear interpolation of the coarse samples, one axis after the other
+    rows = coarse[first] * (1 - t)[:, None] + coarse[last] * t[:, None]
+    interpolated = rows[:, first] * (1 - t) + rows[:, last] * t
+    return np.abs(interpolated - padded)
+
+
+class QuadtreeTerrain(SharedTextured):
+    """ Chunked terrain drawn from a quadtree. Every node is the same flat patch of
+        patch_cells x patch_cells quads stretched over its area and displaced on the GPU.
+        Each frame, nodes are refined until their projected error is within error_budget
+        pixels, skirts cover the cracks between neighbours of different levels """
+
+    def __init__(self, shader, grid, tex_file, patch_cells=32, error_budget=2.0, **uniforms):
+        self.wrap, self.filter = GL.GL_REPEAT, (GL.GL_NEAREST, GL.GL_NEAREST)
+        self.file = tex_file
+        self.uniforms = uniforms
+        self.patch_cells = patch_cells
+        self.error_budget = error_budget
+        self.shape = grid.shape
+        self.selected = []  # nodes drawn in the last frame
+
+        self.build_tree(np.asarray(grid, np.float32))
+        self.bounds = sphere_around((0, self.low[0][0, 0], 0), (self.shape[0] - 1, self.high[0][0, 0], self.shape[1] - 1))
+
+        positions, indices = build_patch(patch_cells)
+        # patch points are small integers, exact in half floats
+        mesh = Mesh(shader, attributes=dict(position=positions), index=indices, formats=dict(position=HALF))
+        self.height_map = HeightTexture(grid)
+        texture = textures.acquire(tex_file, self.wrap, *self.filter)
+        super().__init__(mesh, diffuse_map=texture, height_map=self.height_map)
+
+    def build_tree(self, grid):
+        """ Height range and geometric error of every quadtree node, one array per depth """
+        cells = max(grid.shape) - 1
+        depths = max(0, int(np.ceil(np.log2(cells / self.patch_cells)))) + 1
+        self.root = self.patch_cells * 2 ** (depths - 1)
+        # the shader clamps lookups to the map, edge padding reproduces that
+        padded = np.pad(grid, ((0, self.root + 1 - grid.shape[0]), (0, self.root + 1 - grid.shape[1])), mode='edge')
+
+        self.errors, self.low, self.high = [], [], []
+        for depth in range(depths):
+            nodes, size = 2 ** depth, self.root >> depth
+            step = size // self.patch_cells
+
+            def per_node(values, reduce):
+                return reduce(values[:self.root, :self.root].reshape(nodes, size, nodes, size), axis=(1, 3))
+            self.errors.append(per_node(lod_errors(padded, step), np.max))
+            self.low.append(per_node(padded, np.min))
+            self.high.append(per_node(padded, np.max))
+
+        # a node can not be more accurate than its children
+        for depth in range(depths - 2, -1, -1):
+            nodes = 2 ** depth
+            children = self.errors[depth + 1].reshape(nodes, 2, nodes, 2).max(axis=(1, 3))
+            self.errors[depth] = np.maximum(self.errors[depth], children)
+
+    def select(self, camera, pixel_scale, culling=None, model=None):
+        """ Quadtree nodes (depth, i, j) to draw for a camera in terrain coordinates.
+            With culling, nodes out of view are dropped with their whole subtree,
+            each counted as one culled chunk """
+        selected, stack = [], [(0, 0, 0)]
+        while stack:
+            depth, i, j = stack.pop()
+            size = self.root >> depth
+            x, z = i * size, j * size
+            if x >= self.shape[0] - 1 or z >= self.shape[1] - 1:
+                continue  # only padding
+
+            # distance from the camera to the node bounding box
+            low = np.array((x, self.low[depth][i, j], z))
+            high = np.array((x + size, self.high[depth][i, j], z + size))
+            if culling is not None and not culling.visible(sphere_around(low, high), model):
+                culling.culled += 1
+                continue
+            distance = np.linalg.norm(np.maximum(np.maximum(low - camera, camera - high), 0))
+            error = self.errors[depth][i, j] * pixel_scale / max(distance, 1e-6)
+
+            if error <= self.error_budget or depth == len(self.errors) - 1:
+                selected.append((depth, i, j))
+            else:
+                stack.extend((depth + 1, 2 * i + a, 2 * j + b) for a in (0, 1) for b in (0, 1))
+        return selected
+
+    def draw(self, primitives=GL.GL_TRIANGLES, model=None, projection=None, w_camera_position=None,
+             win_size=(640, 480), culling=None, **uniforms):
+        uniforms = {**self.uniforms, **uniforms, 'model': model, 'projection': projection,
+                    'w_camera_position': w_camera_position}
+
+        # camera in terrain coordinates, error scale from world units at distance 1 to pixels
+        camera = (np.linalg.inv(model) @ w_camera_position)[:3]
+        pixel_scale = projection[1, 1] * win_size[1] / 2
+        self.selected = self.select(camera, pixel_scale, culling, model)
+
+        for index, (name, texture) in enumerate(self.textures.items()):
+            GL.glActiveTexture(GL.GL_TEXTURE0 + index)
+            GL.glBindTexture(texture.type, texture.glid)
+            uniforms[name] = index
+        for depth, i, j in self.selected:
+            size = self.root >> depth
+            self.drawable.draw(primitives=primitives, patch_origin=(i * size, j * size),
+                               patch_step=size // self.patch_cells, skirt_depth=self.errors[depth][i, j] + 1,
+                               culling=culling, **uniforms)
+
+
+class HeightField:
+    """ Vectorized queries of the ground surface, bilinear between grid points.
+        Grid point (i, j) of the heightmap is at (i, grid[i, j], j) - origin in scene coordinates """
+
+    def __init__(self, grid, origin=(0, 0, 0)):
+        self.grid = grid
+        self.origin = np.asarray(origin, np.float64)
+
+    def sample(self, coords):
+        """ Heights, unit surface normals and out of bounds mask at N x 2 (x, z) scene coordinates.
+            Points out of the map are clamped to its border """
+        coords = np.asarray(coords, np.float64).reshape(-1, 2)
+        points = coords + self.origin[[0, 2]]
+        last = np.array(self.grid.shape) - 1
+        clamped = np.clip(points, 0, last)
+        outside = np.any(clamped != points, axis=1)
+
+        cell = np.minimum(np.floor(clamped).astype(int), last - 1)
+        tx, tz = (clamped - cell).T
+        x, z = cell.T
+        h00, h10 = self.grid[x, z], self.grid[x + 1, z]
+        h01, h11 = self.grid[x, z + 1], self.grid[x + 1, z + 1]
+
+        heights = (h00 * (1 - tx) + h10 * tx) * (1 - tz) + (h01 * (1 - tx) + h11 * tx) * tz
+        # partial derivatives of the bilinear patch give the geometric normal (-dh/dx, 1, -dh/dz)
+        dx = (h10 - h00) * (1 - tz) + (h11 - h01) * tz
+        dz = (h01 - h00) * (1 - tx) + (h11 - h10) * tx
+        normals = np.stack((-dx, np.ones_like(dx), -dz), axis=1)
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        return heights - self.origin[1], normals, outside
+
+    def heights(self, coords):
+        return self.sample(coords)[0]
+
+    def normals(self, coords):
+        return self.sample(coords)[1]
+
+    def placements(self, coords, align=False, lift=0.0):
+        """ N x 4 x 4 transforms standing objects on the ground at (x, z) coords, lifted by lift.
+            With align, their up axis follows the slope instead of staying vertical """
+        coords = np.asarray(coords, np.float64).reshape(-1, 2)
+        heights, normals, outside = self.sample(coords)
+        if np.any(outside):
+            print(f'Placing objects: {np.count_nonzero(outside)} of {len(coords)} out of bounds, '
+                  f'clamped to the terrain border', file=sys.stderr)
+        clamped = np.clip(coords + self.origin[[0, 2]], 0, np.array(self.grid.shape) - 1) - self.origin[[0, 2]]
+
+        transforms = np.tile(np.identity(4, np.float32), (len(coords), 1, 1))
+        if align:
+            # rotation of (0, 1, 0) onto the normal: I + K + K^2 / (1 + cos), K cross product by up x normal
+            nx, ny, nz = normals.T
+            zero = np.zeros_like(nx)
+            cross = np.stack((np.stack((zero, nx, zero), 1),
+                              np.stack((-nx, zero, -nz), 1),
+                              np.stack((zero, nz, zero), 1)), 1)
+            transforms[:, :3, :3] += cross + cross @ cross / (1 + ny)[:, None, None]
+        transforms[:, :3, 3] = np.stack((clamped[:, 0], heights + lift, clamped[:, 1]), axis=1)
+        return transforms
+
+    def place(self, node, coords, align=False, lift=0.0):
+        """ Stand one scene node on the ground at (x, z) """
+        self.place_all([node], [coords], align, lift)
+
+    def place_all(self, nodes, coords, align=False, lift=0.0):
+        """ Stand every node on the ground at its (x, z), the terrain is queried once for all """
+        for node, transform in zip(nodes, self.placements(coords, align, lift)):
+            node.apply(transform)
@@ -0,0 +1,83 @@
+# standard library
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from os.path import join, getsize
+
+# external libraries
+import numpy as np
+
+# local imports
+from generate_terrain import bake_terrain, save_baked, load_baked, TERRAIN_FORMAT
+
+
+class TerrainCache:
+    """ Baked terrains on disk, keyed by a hash of their generation parameters,
+        one directory of memory-mappable .npy arrays per terrain.
+        Least recently used variants are evicted once the cache outgrows max_bytes. """
+
+    def __init__(self, directory='assets/terrain_cache', max_bytes=512 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(**params):
+        """ Hash of the full parameter set of bake_terrain, defaults included """
+        bound = inspect.signature(bake_terrain).bind(**params)
+        bound.apply_defaults()
+        params = {name: None if value is None else np.asarray(value).tolist()
+                  for name, value in bound.arguments.items() if name != 'workers'}
+        params['format'] = TERRAIN_FORMAT
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return join(self.directory, key)
+
+    def get(self, workers=1, **params):
+        """ Terrain arrays for params, memory-mapped on a hit, generated and stored on a miss """
+        path = self.path(self.key(**params))
+        if os.path.isdir(path):
+            print(f'Terrain cache hit: {path}')
+            os.utime(path)  # modification time is the last use, for LRU eviction
+            return load_baked(path)
+
+        print(f'Terrain cache miss, generating: {params}')
+        baked = bake_terrain(workers=workers, **params)
+        # write under a temporary name first, a concurrent reader never sees half a terrain
+        shutil.rmtree(path + '.tmp', ignore_errors=True)
+        save_baked(path + '.tmp', **baked)
+        try:
+            os.replace(path + '.tmp', path)
+        except OSError:  # stored meanwhile by another process
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+        self.evict(keep=path)
+        return baked
+
+    def entries(self):
+        """ Cached terrains, least recently used first """
+        paths = [join(self.directory, d) for d in os.listdir(self.directory)
+                 if os.path.isdir(join(self.directory, d)) and not d.endswith('.tmp')]
+        return sorted(paths, key=os.path.getmtime)
+
+    @staticmethod
+    def size(path):
+        return sum(getsize(join(path, f)) for f in os.listdir(path))
+
+    def evict(self, keep=None):
+        """ Remove least recently used terrains until the cache fits in max_bytes """
+        paths = self.entries()
+        total = sum(self.size(p) for p in paths)
+        for path in paths:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                total -= self.size(path)
+                shutil.rmtree(path)
+                print(f'Terrain cache evicted: {path}')
+
+    def clear(self):
+        for path in self.entries():
+            shutil.rmtree(path)
@@ -0,0 +1,96 @@
+# standard library
+import os
+from collections import OrderedDict
+
+# external libraries
+import OpenGL.GL as GL
+
+# local imports
+from texture import Texture, Textured
+
+
+class TextureCache:
+    """ GPU textures shared by everything drawing the same image with the same modes,
+        keyed by (resolved path, wrap, mag / min filter, type) and reference counted.
+        Released textures stay resident for reuse, least recently used ones are
+        evicted once resident textures outgrow max_bytes of VRAM. """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> [texture, references, bytes], least recently used first
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(tex_file, wrap_mode, mag_filter, min_filter, tex_type):
+        return os.path.realpath(tex_file), int(wrap_mode), int(mag_filter), int(min_filter), int(tex_type)
+
+    def acquire(self, tex_file, wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_LINEAR,
+                min_filter=GL.GL_LINEAR_MIPMAP_LINEAR, tex_type=GL.GL_TEXTURE_2D):
+        """ Shared texture, same arguments as Texture; decoded and uploaded on a miss only """
+        key = self.key(tex_file, wrap_mode, mag_filter, min_filter, tex_type)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            entry[1] += 1
+            return entry[0]
+
+        self.misses += 1
+        texture = Texture(tex_file, wrap_mode, mag_filter, min_filter, tex_type)
+        self.entries[key] = [texture, 1, self.size(texture)]
+        self.evict()
+        return texture
+
+    def release(self, texture):
+        """ Drop one reference, the texture becomes evictable once nothing holds it """
+        for entry in self.entries.values():
+            if entry[0] is texture:
+                entry[1] -= 1
+                break
+        self.evict()
+
+    @staticmethod
+    def size(texture):
+        """ VRAM of an RGBA8 texture and its mipmaps """
+        GL.glBindTexture(texture.type, texture.glid)
+        width = GL.glGetTexLevelParameteriv(texture.type, 0, GL.GL_TEXTURE_WIDTH)
+        height = GL.glGetTexLevelParameteriv(texture.type, 0, GL.GL_TEXTURE_HEIGHT)
+        return int(width) * int(height) * 4 * 4 // 3
+
+    def resident_bytes(self):
+        return sum(entry[2] for entry in self.entries.values())
+
+    def evict(self):
+        """ Delete unreferenced textures, least recently used first, until resident ones fit in max_bytes """
+        total = self.resident_bytes()
+        for key, (texture, references, size) in list(self.entries.items()):
+            if total <= self.max_bytes:
+                break
+            if references <= 0:
+                total -= size
+                del self.entries[key]  # GL texture deleted with the last Python reference
+                self.evictions += 1
+                print(f'Texture cache evicted: {key[0]}')
+
+    def report(self):
+        return (f'Textures: {len(self.entries)} resident, {self.resident_bytes() / 2 ** 20:.2f} MB of '
+                f'{self.max_bytes / 2 ** 20:.0f} MB, {self.hits} hits, {self.misses} misses, '
+                f'{self.evictions} evictions')
+
+
+# shared by every loader and textured object
+textures = TextureCache()
+
+
+class SharedTextured(Textured):
+    """ Textured decorator for textures acquired from the shared cache, given back by
+        release() or once the drawable is dropped; textures not from the cache are ignored """
+
+    def release(self):
+        """ Release every texture once, the drawable is not drawn afterwards """
+        for texture in self.textures.values():
+            textures.release(texture)
+        self.textures = {}
+
+    def __del__(self):
+        self.release()
@@ -2,22 +2,31 @@
 # standard library imports
 import sys
 from itertools import cycle
+from os.path import isdir
 # external libraries
 import numpy as np  # all matrix manipulations & OpenGL args
 
 # import lab3.cactus
 # local imports
-from core import Shader, Viewer, load, Node
+from core import Shader, Viewer, load, Node, HALF, vertex_memory_report, mesh_cache
 from objects import TexturedMesh, Axis, TexturedPlaneShaded
 from transform import translate, scale, rotate, identity
 from cactus import CactusBuilder
 from skybox import Skybox
+from generate_terrain import VOLCANO, load_baked
+from terrain_cache import TerrainCache
+from texture_cache import textures
+from terrain import HeightmapTerrain, QuadtreeTerrain, HeightField, EditableTerrain
 
 
 # -------------- main program and scene setup --------------------------------
 def main():
     print("The controls are the same as in labs: use left and right mouse buttons to rotate and move the camera, respectively.")
     print("Use S to start a cactus-tornado.")
+    print("Run with --gpu-terrain to displace the terrain from its heightmap on the GPU,")
+    print("or with --lod-terrain to also draw it in quadtree chunks with a per-frame level of detail.")
+    print("Run with --edit-terrain to sculpt the terrain at the center of the view:")
+    print("press 1 to raise it, 2 to lower it, 3 to flatten it or 4 to dig a crater.")
 
     """ create a window, add scene objects, then run rendering loop """
     viewer = Viewer()
@@ -62,10 +71,13 @@ def main():
 
     ''' Terrain '''
     # todo make terrain a class
-    # Don't forget to run the generate_terrain.py script to generate the terrain file
-    terrain = np.load('assets/terrain.npz')
+    # generated on the fly on the first run, then loaded from the terrain cache
+    # a baked terrain (generate_terrain.py) can still be given on the command line
+    terrain_files = [file for file in sys.argv[1:] if file.endswith('.npz') or isdir(file)]
+    terrain = load_baked(terrain_files[0]) if terrain_files else TerrainCache().get(**VOLCANO)
     terrain_vertices = terrain['ground_vertices']
-    # no indices
+    # shared grid vertices with an index buffer, older files only have the 6 vertices per cell soup
+    terrain_indices = terrain.get('ground_indices')
     terrain_normals = terrain['ground_normals']
     terrain_grid = terrain['ground_grid']
     x, z = terrain_grid.shape
@@ -74,33 +86,37 @@ def main():
     terrain_shift = translate(-shift_x, -height_at_center, -shift_z)
 
     # Add terrain to the scene
-    terrain_grass = TexturedMesh(shader_terrain, terrain_vertices, "assets/sand.png",
-                                 normals=terrain_normals,)  # k_s=0,  k_d=(0.5, 0.5, 0.5)
+    if '--lod-terrain' in sys.argv:
+        # quadtree chunks of one displaced patch, level of detail picked per frame from the camera
+        shader_terrain_gpu = Shader("shaders/terrain_displace.vert", "shaders/terrain.frag")
+        terrain_grass = QuadtreeTerrain(shader_terrain_gpu, terrain_grid, "assets/sand.png")
+    elif '--edit-terrain' in sys.argv:
+        # sculpted at the center of the view with keys 1 to 4 (raise, lower, flatten, crater)
+        terrain_grass = EditableTerrain(shader_terrain, terrain_grid, "assets/sand.png")
+        terrain_grid = terrain_grass.grid  # objects are placed on the edited ground
+    elif '--gpu-terrain' in sys.argv:
+        # only the heights are uploaded, the vertex shader displaces a flat grid and derives normals
+        shader_terrain_gpu = Shader("shaders/terrain_displace.vert", "shaders/terrain.frag")
+        terrain_grass = HeightmapTerrain(shader_terrain_gpu, terrain_grid, "assets/sand.png")
+    else:
+        terrain_grass = TexturedMesh(shader_terrain, terrain_vertices, "assets/sand.png", index=terrain_indices,
+                                     normals=terrain_normals,)  # k_s=0,  k_d=(0.5, 0.5, 0.5)
     terrain_node = Node([terrain_grass], transform=terrain_shift)  # shift terrain to be centered
     scene.add(terrain_node)
 
-    # terrain bounds in scene coordinates
-    x_min, z_min = 0 - shift_x, 0 - shift_z
-    x_max, z_max = x - shift_x, z - shift_z
+    # ground queries in scene coordinates, terrain is shifted by (-shift_x, -height_at_center, -shift_z)
+    ground = HeightField(terrain_grid, origin=(shift_x, height_at_center, shift_z))
 
-    def place(obj, coords):
+    def place(obj, coords, align=False):
         """
         Place an object on the terrain at the given coordinates
-        terrain is shifted (horizontally) by (-shift_x, -shift_z)
 
         :param obj: object to place
         :param coords: (x, z) coordinates in scene coordinates
+        :param align: follow the slope instead of standing vertically
         """
-        x, z = int(coords[0]), int(coords[1])
-        if x < x_min or x > x_max or z < z_min or z > z_max:
-            x = np.clip(x, x_min, x_max)
-            z = np.clip(z, z_min, z_max)
-            print(f"Placing object: coords ({x}, {z}) out of bounds, clipping to ({x}, {z}).", file=sys.stderr)
-
-        # terrain_grid height at (x, z) is terrain_mesh height at (x + shift_x, z + shift_z)
-        y = terrain_grid[x + shift_x, z + shift_z]
-        obj.apply(translate(x, y, z) @ translate(y=-height_at_center + 0.5))
-        # object might end up inside the terrain - temporary solution: whole terrain is shifted down by 0.5
+        # lifted by 0.5 as before, so objects are not sunk into the ground
+        ground.place(obj, coords, align, lift=0.5)
 
 
     ''' Water/Lava '''
@@ -109,14 +125,17 @@ def main():
     water_level = np.quantile(terrain_grid, 0.25)
 
     lava_vertices = terrain['lava_vertices']
-    lava_normals = terrain['lava_normals']
+    lava_indices = terrain.get('lava_indices')  # one quad per cell and no indices in older files
 
     lava_center = np.array(lava_vertices.mean(axis=0), dtype=int)
     lx, ly, lz = lava_center
     # lava_center = (lx - shift_x, ly - height_at_center, lz - shift_z)
 
 
-    lava = TexturedMesh(shader_lava, lava_vertices, "assets/lava.jpg", normals=lava_normals)
+    # half float positions: x and z are integers, the height is off by less than the 0.5 safety margin
+    lava = TexturedMesh(shader_lava, lava_vertices, "assets/lava.jpg", index=lava_indices,
+                        formats=dict(position=HALF))
+    lava.bounds = None  # lava.vert waves the vertices in clip space, never culled
     lava_node = Node([lava], transform=terrain_shift)  #
     scene.add(lava_node)
 
@@ -174,11 +193,15 @@ def main():
         # offset_sum += offset
         # cact.apply(offset_sum)
         cact.apply(rotate(axis=(0, 1, 0), angle=pos[0]))
-        place(cact, pos)
         cacti_list.append(cact)
         scene.add(cact)
+    # all cacti stood on the ground in one terrain query
+    ground.place_all(cacti_list, cacti_pos, lift=0.5)
 
     viewer.cacti_list = cacti_list
+    print(vertex_memory_report())
+    print(textures.report())
+    print(mesh_cache.report())
     # start rendering loop
     viewer.run()
 
@@ -188,7 +211,7 @@ if __name__ == '__main__':
     # TODO
     """
     - terrain:
-        - generation can run on the fly
+        - generation can run on the fly  #DONE#
         - make into a class
         - grass texture mapping is wrong  #DONE#
         - remove regular grid artifacts  #DONE#